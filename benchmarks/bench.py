@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""Benchmark pull, user-section extraction, install and merge paths of HostsUpdator.
+
+Usage: `python benchmarks/bench.py [--sizes 10000,100000] [--workloads pull_cold,install] [-o result.json]`
+
+Synthetic hosts files are generated under a work directory (reused between runs)
+and served by a local HTTP server standing in for the remote sources. Every
+workload runs in a fresh subprocess so that its peak RSS can be reported. The
+system hosts is never touched: installs go to a temporary hosts directory and
+`after_use` is a no-op.
+
+The result is printed as JSON, one record per (workload, size), with elapsed
+seconds, lines/s, MB/s and peak RSS in MB.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_ROOT)
+
+DEFAULT_SIZES = (10000, 100000, 1000000, 5000000)
+WORKLOADS = ('pull_cold', 'pull_unchanged', 'pull_changed', 'user_section',
+    'install', 'install_noop', 'merge')
+
+
+# ------------------------------ synthetic data ------------------------------ #
+
+# 生成 n 行 hosts，主机名编号从 offset 开始；约 1% 的注释行和 5% 的 IPv6 映射
+def generate_hosts(path, n, offset=0):
+    with open(path, 'w') as f:
+        f.write('# synthetic hosts: %d lines, offset %d\n' %(n, offset))
+        for i in range(offset, offset + n):
+            if i % 100 == 0:
+                f.write('# section %d\n' %(i // 100))
+            elif i % 20 == 0:
+                f.write('::1 host%d.example.com\n' %i)
+            else:
+                f.write('0.0.0.0 host%d.example.com\n' %i)
+
+
+# 准备某个规模的数据文件：a/b/c 三个变体依次错开一半，用于变化和合并测试
+def prepare_data(work_dir, size):
+    paths = {}
+    for i, variant in enumerate('abc'):
+        path = os.path.join(work_dir, 'hosts-%d-%s.txt' %(size, variant))
+        if not os.path.isfile(path):
+            generate_hosts(path + '.tmp', size, offset=i * size // 2)
+            os.rename(path + '.tmp', path)
+        paths[variant] = path
+    return paths
+
+
+# ------------------------------ local server ------------------------------ #
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """Serves `/<size>/<variant>` from the generated files with ETag support.
+    `/<size>/flip` alternates between variants a and b on every request.\n"""
+    files = {}
+    flips = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        size, variant = parts[0], parts[1]
+        if variant == 'flip':
+            with self.lock:
+                variant = self.flips[size] = 'b' if self.flips.get(size) == 'a' else 'a'
+        path = self.files.get((int(size), variant))
+        if path is None:
+            self.send_error(404)
+            return
+        st = os.stat(path)
+        etag = '"%s"' %hashlib.md5(('%s:%d:%d' %(path, st.st_size, st.st_mtime)).encode('utf8')).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(st.st_size))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, 64 * 1024)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(files):
+    SourceHandler.files = files
+    server = ThreadingServer(('127.0.0.1', 0), SourceHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' %server.server_address[1]
+
+
+# ------------------------------ workloads ------------------------------ #
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return round(rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def make_updator_class():
+    from util.updator import HostsUpdator
+
+    class BenchUpdator(HostsUpdator):
+        """HostsUpdator that installs into a temporary hosts directory.\n"""
+        def __init__(self, name, url, app_root, hosts_dir, **kw):
+            self.bench_hosts_dir = hosts_dir
+            HostsUpdator.__init__(self, name, url, app_root, **kw)
+
+        def _get_hosts_dir(self):
+            return self.bench_hosts_dir
+
+        def after_use(self):
+            pass
+
+    return BenchUpdator
+
+
+def timed(func, *args, **kw):
+    start = time.time()
+    func(*args, **kw)
+    return time.time() - start
+
+
+# 在子进程中执行单个测试，返回 (耗时, 处理的行数, 处理的字节数)
+def run_workload(workload, size, base_url, data_dir):
+    import logging
+    from util.updator import SEPARATOR
+    logging.getLogger('HostsUpdator').setLevel(logging.WARNING)
+    Updator = make_updator_class()
+    app_root = tempfile.mkdtemp(prefix='hman-bench-app-')
+    hosts_dir = tempfile.mkdtemp(prefix='hman-bench-etc-')
+    data = prepare_data(data_dir, size)
+    nbytes = os.path.getsize(data['a'])
+    lines = size
+
+    def updator(name, variant):
+        return Updator(name, '%s%d/%s' %(base_url, size, variant), app_root, hosts_dir)
+
+    try:
+        if workload == 'pull_cold':
+            elapsed = timed(updator('a', 'a').pull)
+        elif workload == 'pull_unchanged':
+            u = updator('a', 'a')
+            u.pull()
+            elapsed = timed(u.pull)
+        elif workload == 'pull_changed':
+            u = updator('a', 'flip')
+            u.pull()
+            elapsed = timed(u.pull)
+        elif workload == 'user_section':
+            # 整个数据文件都在用户自定义部分，分隔行位于末尾
+            hosts_file = os.path.join(hosts_dir, 'hosts')
+            shutil.copyfile(data['a'], hosts_file)
+            with open(hosts_file, 'a') as f:
+                f.write(SEPARATOR + '\n')
+            elapsed = timed(updator('a', 'a').get_user_hosts)
+        elif workload == 'install':
+            u = updator('a', 'a')
+            u.pull()
+            elapsed = timed(u.use)
+        elif workload == 'install_noop':
+            u = updator('a', 'a')
+            u.pull()
+            u.use()
+            elapsed = timed(u.use)
+        elif workload == 'merge':
+            updators = [updator(v, v) for v in 'abc']
+            for u in updators:
+                u.pull()
+            elapsed = timed(updators[0].use, merge_with=updators[1:])
+            lines *= 3
+            nbytes = sum(os.path.getsize(data[v]) for v in 'abc')
+        else:
+            raise ValueError('Unknown workload: %s' %workload)
+    finally:
+        shutil.rmtree(app_root, ignore_errors=True)
+        shutil.rmtree(hosts_dir, ignore_errors=True)
+    return elapsed, lines, nbytes
+
+
+def worker_main(args):
+    elapsed, lines, nbytes = run_workload(args.worker, args.size, args.base_url, args.data_dir)
+    print(json.dumps({'elapsed': elapsed, 'lines': lines, 'bytes': nbytes, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def run_in_subprocess(workload, size, base_url, data_dir):
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', workload, '--size', str(size),
+        '--base-url', base_url, '--data-dir', data_dir]
+    out = subprocess.check_output(cmd).decode('utf8')
+    r = json.loads(out.strip().splitlines()[-1])
+    elapsed = max(r['elapsed'], 1e-9)
+    return {
+        'workload': workload,
+        'size': size,
+        'elapsed': round(r['elapsed'], 4),
+        'lines_per_sec': int(r['lines'] / elapsed),
+        'mb_per_sec': round(r['bytes'] / elapsed / 1024 / 1024, 2),
+        'peak_rss_mb': r['peak_rss_mb'],
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Benchmark hman pull/parse/merge/install paths.')
+    ap.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+        help='comma separated line counts (default: %(default)s)')
+    ap.add_argument('--workloads', default=','.join(WORKLOADS),
+        help='comma separated workloads (default: %(default)s)')
+    ap.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'hman-bench-data'),
+        help='where synthetic hosts files are generated and cached')
+    ap.add_argument('-o', '--output', help='also write the JSON result to this file')
+    ap.add_argument('--worker', help=argparse.SUPPRESS)
+    ap.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    ap.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.worker:
+        return worker_main(args)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    workloads = [w for w in args.workloads.split(',') if w]
+    for w in workloads:
+        if w not in WORKLOADS:
+            ap.error('unknown workload "%s", must be in %s' %(w, ', '.join(WORKLOADS)))
+    if not os.path.isdir(args.data_dir):
+        os.makedirs(args.data_dir)
+    files = {}
+    for size in sizes:
+        sys.stderr.write('Preparing %d-line sources ...\n' %size)
+        for variant, path in prepare_data(args.data_dir, size).items():
+            files[(size, variant)] = path
+    server, base_url = start_server(files)
+    results = []
+    try:
+        for size in sizes:
+            for workload in workloads:
+                sys.stderr.write('Running %s with %d lines ...\n' %(workload, size))
+                results.append(run_in_subprocess(workload, size, base_url, args.data_dir))
+    finally:
+        server.shutdown()
+    report = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results,
+    }
+    text = json.dumps(report, indent=4, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Measure the startup time of one-shot hman commands.
+
+Usage: `python benchmarks/startup.py [-n runs] [command ...]`
+Runs `python hman.py <command>` repeatedly (default: `list`) and prints the
+timings in milliseconds as JSON, next to a bare `python -c pass` baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HMAN = os.path.join(APP_ROOT, 'hman.py')
+
+
+def measure(cmd, runs):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(cmd, stdout=devnull, stderr=devnull, cwd=APP_ROOT)
+            timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return {
+        'command': ' '.join(cmd[1:]),
+        'runs': runs,
+        'min_ms': round(timings[0], 2),
+        'median_ms': round(timings[len(timings) // 2], 2),
+        'max_ms': round(timings[-1], 2),
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Benchmark hman one-shot startup time.')
+    ap.add_argument('-n', '--runs', type=int, default=20)
+    ap.add_argument('command', nargs='*', default=['list'])
+    args = ap.parse_args(argv)
+    baseline = measure([sys.executable, '-c', 'pass'], args.runs)
+    result = measure([sys.executable, HMAN] + args.command, args.runs)
+    result['baseline_median_ms'] = baseline['median_ms']
+    result['overhead_median_ms'] = round(result['median_ms'] - baseline['median_ms'], 2)
+    print(json.dumps(result, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
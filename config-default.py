@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from util import updator, validator, history, daemon
+from util.filelock import LOCK_TIMEOUT
+
 sources = [
     {
         "name": "gg",
@@ -29,3 +32,33 @@ sources = [
 ]
 
 current = sources[0]['name']
+
+settings = {
+    "after_use_hooks": "auto",
+    "backup_keep_days": updator.BACKUP_KEEP_DAYS,
+    "backup_keep_last": updator.BACKUP_KEEP_LAST,
+    "cache_format": "",
+    "connect_timeout": updator.CONNECT_TIMEOUT,
+    "filters": {
+        "allow": [],
+        "deny": []
+    },
+    "history_keep": history.HISTORY_KEEP,
+    "index_on_pull": False,
+    "lock_timeout": LOCK_TIMEOUT,
+    "max_invalid_ratio": validator.MAX_INVALID_RATIO,
+    "max_shrink": validator.MAX_SHRINK,
+    "metrics_log": "",
+    "metrics_textfile": "",
+    "pull_retries": updator.PULL_RETRIES,
+    "pull_workers": updator.PULL_WORKERS,
+    "race_mirrors": False,
+    "read_timeout": updator.READ_TIMEOUT,
+    "refresh_interval": daemon.REFRESH_INTERVAL,
+    "refresh_jitter": daemon.REFRESH_JITTER,
+    "render_cache_size": updator.RENDER_CACHE_SIZE,
+    "retry_backoff": updator.RETRY_BACKOFF,
+    "retry_backoff_max": updator.RETRY_BACKOFF_MAX,
+    "validate_pull": True,
+    "verify_install": False
+}
@@ -2,12 +2,19 @@
 
 import os
 import sys
-import json
-import shutil
+import time
+import logging
+import contextlib
 from cmd import Cmd
+try:
+    from shlex import quote
+except ImportError:
+    # Python 2
+    from pipes import quote
 
 from util import parameter as p
-from util.updator import HostsUpdator
+
+# 重量级模块（如 util.updator、json）在用到时才导入，使 `hman.py list` 等一次性命令尽快启动
 
 help_message = '''
 Usage:
@@ -16,7 +23,12 @@ Usage:
 Commands:
   h:      \tShow this help message.
   add:    \tAdd a new source.
+  daemon: \tRun in background, refreshing sources and reinstalling hosts when they change.
+  diff:   \tShow hostnames changed by the last pull of a source.
+  grep:   \tSearch hostnames of all pulled sources by pattern.
   help:   \tShow help message for a specified command.
+  history:\tList saved versions of a source.
+  lint:   \tValidate the cached hosts of a source.
   list:   \tList all the sources available. Source in use starts with "*".
   ls:     \tAlias of `list`.
   pull:   \tPull and store hosts from remote.
@@ -25,9 +37,26 @@ Commands:
   remove: \tRemove existing source(s).
   rm:     \tAlias of `remove`.
   reorder:\tReorder a source.
+  restore:\tList backups of system hosts or restore one of them.
+  status: \tShow status of the daemon.
   use:    \tUse specified source as system hosts.
+  which:  \tShow which sources map a hostname.
 '''
 
+# diff 命令默认显示的主机名个数
+DIFF_LIMIT = 20
+
+# grep 命令默认显示的主机名个数
+GREP_LIMIT = 50
+
+# 一次性命令的退出码
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+
+# 不修改配置和系统 hosts 的命令，一次性执行时不需要管理员权限
+READ_ONLY_COMMANDS = ('h', 'help', 'list', 'ls', 'diff', 'status', 'which', 'grep', 'lint', 'history')
+
 
 class HostsManager(Cmd):
     """Hosts Manager CLI."""
@@ -36,23 +65,78 @@ class HostsManager(Cmd):
 
     def __init__(self):
         Cmd.__init__(self)
+        from util.store import ConfigStore
+        self.app_root = os.path.dirname(os.path.abspath(sys.modules[self.__module__].__file__))
+        self.store = ConfigStore(self.app_root)
+        self.exit_code = EXIT_OK
+        state = self.store.read()
+        self._apply_config(state if 'sources' in state else self._migrate_config())
+
+
+    # 使用存储中的配置，settings 以 config-default.py 中的默认值为基础
+    def _apply_config(self, state):
+        self.sources = state['sources']
+        # current 为正在使用的源名称列表，兼容旧配置中的单个名称
+        current = state['current']
+        self.current = current if isinstance(current, list) else [current]
+        # 由 `use name@version` 安装的历史版本，{源名称: 版本}，守护进程不会用最新内容覆盖它们
+        self.versions = state.get('versions', {})
+        self.settings = dict(__import__('config-default').settings)
+        self.settings.update(state.get('settings', {}))
+        self.store.lock.timeout = self.settings['lock_timeout']
+
+
+    # 首次运行时从旧版本的 config.py（没有则为 config-default.py）生成 data/config.json，
+    # 并迁移 data/<name>/ 下的 md5.txt 等元数据文件
+    def _migrate_config(self):
         try:
             import config
         except ImportError:
             config = __import__('config-default')
-        self.sources = config.sources
-        self.current = config.current
-        self.app_root = os.path.dirname(os.path.abspath(sys.modules[self.__module__].__file__))
+        legacy = {'sources': config.sources, 'current': config.current,
+            'settings': self._setting_overrides(getattr(config, 'settings', {}))}
+        try:
+            with self.store.transaction() as state:
+                if 'sources' not in state:
+                    state.update(legacy)
+                    self.store.migrate_legacy_meta(state, [src['name'] for src in legacy['sources']])
+                return dict(state)
+        except (IOError, OSError):
+            # 没有写权限时（如以普通用户执行只读命令）只在内存中使用旧配置
+            return legacy
+
+
+    # 修改配置：加锁并重新读取最新的配置，with 块结束后原子地写回 data/config.json
+    # 产生的值为存储的全部内容，可以直接修改其中的 meta
+    @contextlib.contextmanager
+    def _update_config(self):
+        with self.store.transaction() as state:
+            if 'sources' in state:
+                self._apply_config(state)
+            yield state
+            versions = dict((n, v) for n, v in self.versions.items() if n in self.current)
+            state.update({'sources': self.sources, 'current': self.current, 'versions': versions,
+                'settings': self._setting_overrides(self.settings)})
+
+
+    # 只保存与 config-default.py 中默认值不同的设置，默认值以后的修改对已有的配置同样生效
+    @staticmethod
+    def _setting_overrides(settings):
+        defaults = __import__('config-default').settings
+        return dict((k, v) for k, v in settings.items() if k not in defaults or defaults[k] != v)
+
+
+    # 重新读取配置，以看到其他 hman 进程的修改
+    def _reload_config(self):
+        state = self.store.read()
+        if 'sources' in state:
+            self._apply_config(state)
 
 
-    def _rewrite_config(self):
-        config_dict = { "current": self.current, "sources": self.sources }
-        config_file = os.path.join(self.app_root, 'config.py')
-        with open(config_file, 'w') as f:
-            f.write('# -*- coding: utf-8 -*-\n')
-            for k, v in sorted(config_dict.items()):
-                s = '\n{name} = {value}\n'.format(name=k, value=json.dumps(v, indent=4, sort_keys=True))
-                f.write(s)
+    # 交互模式下每条命令执行前重新读取配置
+    def precmd(self, line):
+        self._reload_config()
+        return line
 
 
     def _get_source_by_name(self, name):
@@ -61,27 +145,104 @@ class HostsManager(Cmd):
                 return src
 
 
+    # 源的过滤规则：全局 settings 中的规则加上源自身的规则
+    def _get_filters(self, src):
+        filters = {}
+        for key in ('allow', 'deny'):
+            filters[key] = list(self.settings['filters'].get(key, [])) + list(src.get('filters', {}).get(key, []))
+        return filters
+
+
+    # 根据源配置创建 updator，源自身的配置项优先于全局 settings
+    def _make_updator(self, src):
+        from util.updator import HostsUpdator
+        get = lambda key: src.get(key, self.settings[key])
+        return HostsUpdator(src['name'], src['url'], self.app_root,
+            connect_timeout=get('connect_timeout'), read_timeout=get('read_timeout'),
+            cache_format=self.settings['cache_format'], render_cache_size=self.settings['render_cache_size'],
+            verify_install=self.settings['verify_install'],
+            backup_keep_last=self.settings['backup_keep_last'], backup_keep_days=self.settings['backup_keep_days'],
+            retries=get('pull_retries'), retry_backoff=self.settings['retry_backoff'],
+            retry_backoff_max=self.settings['retry_backoff_max'], race_mirrors=get('race_mirrors'),
+            after_use_hooks=self.settings['after_use_hooks'],
+            filters=self._get_filters(src), store=self.store, lock_timeout=self.settings['lock_timeout'],
+            validate_pull=get('validate_pull'), max_shrink=get('max_shrink'), max_invalid_ratio=get('max_invalid_ratio'),
+            history_keep=get('history_keep'))
+
+
+    # 拉取（以及安装）完成后为内容变化的源重建主机名索引，使用各源最新的缓存
+    def _index_updated(self, results):
+        if not self.settings['index_on_pull']:
+            return
+        from util.updator import index_sources
+        names = [r['name'] for r in results if r['status'] == 'updated']
+        index_sources(self.app_root, [self._make_updator(self._get_source_by_name(name)) for name in names])
+
+
     @staticmethod
     def rmdir(dirname):
+        import shutil
         if os.path.isdir(dirname):
             shutil.rmtree(dirname)
 
 
+    # 源的 url 可以是多个镜像地址的列表，显示时以逗号分隔
+    @staticmethod
+    def format_url(src):
+        url = src['url']
+        return ', '.join(url) if isinstance(url, list) else url
+
+
     def get_all_names(self):
         return [src['name'] for src in self.sources]
 
 
+    def get_use_choices(self):
+        return self.get_all_names() + ['-p', '--pull']
+
+
+    # 执行一条命令并返回退出码，用于非交互的一次性调用，如 `hman.py use gg --pull`
+    # 参数错误或未知命令返回 EXIT_USAGE，命令执行失败返回 EXIT_FAILURE
+    def run_once(self, args):
+        # 逐个加引号，使含空格或通配符的参数原样传给命令
+        line = ' '.join(quote(a) for a in args)
+        self.exit_code = EXIT_OK
+        try:
+            if self.onecmd(line) is False:
+                self.exit_code = EXIT_USAGE
+        except Exception as e:
+            print('*** Error: %s\n' %e)
+            self.exit_code = EXIT_FAILURE
+        return self.exit_code
+
+
+    # 执行一条命令；配置了 metrics_log 或 metrics_textfile 时记录命令的耗时和退出码，
+    # 并导出命令执行期间记录的指标（见 util/metrics.py）
+    def onecmd(self, line):
+        if not (self.settings['metrics_log'] or self.settings['metrics_textfile']) or not line.split():
+            return Cmd.onecmd(self, line)
+        from util import metrics
+        start = time.time()
+        code = EXIT_FAILURE
+        try:
+            stop = Cmd.onecmd(self, line)
+            code = EXIT_USAGE if stop is False else self.exit_code
+            return stop
+        finally:
+            metrics.record('command', time.time() - start, command=line.split()[0], status=code)
+            metrics.flush(self.app_root, self.settings['metrics_log'], self.settings['metrics_textfile'])
+
+
+    def default(self, line):
+        Cmd.default(self, line)
+        self.exit_code = EXIT_USAGE
+
+
     def do_h(self, line):
         """Get help message.\n"""
         print(help_message)
 
 
-    def do_rewrite_config(self, line):
-        """Rewrite config.py manually.
-        Generally, hman will rewrite it automaticly after config changed.\n"""
-        self._rewrite_config()
-
-
     def complete_name(self, text, line, begidx, endidx):
         # print('\ntext, line, begidx, endidx: %s\n' %([text, line, begidx, endidx]))
         all_names = self.get_all_names()
@@ -101,13 +262,19 @@ class HostsManager(Cmd):
         """List all the hosts sources. Symbol "*" indicates the one in use.
         Usage: `list` or `ls`.
         Use extra parameter `-a` or `--all` to list detail information.\n"""
+        metas = self.store.read().get('meta', {}) if is_detail else {}
         for index, src in enumerate(self.sources):
-            lead = '*' if src['name'] == self.current else ' '
+            lead = '*' if src['name'] in self.current else ' '
             if is_detail:
                 print('{lead} [{index}]\tname: {name}\n\turl: {url}\n\tnote: {note}'.format(
-                    lead=lead, index=index, name=src['name'], url=src['url'], note=src['note']))
+                    lead=lead, index=index, name=src['name'], url=self.format_url(src), note=src['note']))
+                meta = metas.get(src['name'])
+                if meta and meta.get('last_pull'):
+                    print('\tpulled: {time}, {entries} entries, {size} bytes, md5 {digest}'.format(
+                        time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['last_pull'])),
+                        entries=meta.get('entries', '?'), size=meta.get('size', '?'), digest=meta.get('digest', '?')[:8]))
             else:
-                print('{lead} {name}:\t{url}'.format(lead=lead, name=src['name'], url=src['url']))
+                print('{lead} {name}:\t{url}'.format(lead=lead, name=src['name'], url=self.format_url(src)))
         print('')
 
 
@@ -118,9 +285,8 @@ class HostsManager(Cmd):
     def do_add(self, name, url, note):
         """Add a new source.
         Usage: `add name url [note]`.\n"""
-        all_names = self.get_all_names()
         rewrite = False
-        if name in all_names:
+        if name in self.get_all_names():
             prompt = 'Warning: source "%s" already exists, do you want to overwrite?[Y/n]' %name
             try:
                 answer = raw_input(prompt)
@@ -131,11 +297,15 @@ class HostsManager(Cmd):
                 return
             rewrite = True
         to_add = { 'name': name, 'url': url, 'note': note }
+        with self._update_config():
+            all_names = self.get_all_names()
+            if name in all_names:
+                self.sources[all_names.index(name)].update(to_add)
+            else:
+                self.sources.append(to_add)
         if rewrite:
-            self.sources[all_names.index(name)].update(to_add)
             print('Updated source: %s - %s\n' %(name, url))
             return
-        self.sources.append(to_add)
         print('Added new source: %s - %s\n' %(name, url))
 
 
@@ -143,22 +313,31 @@ class HostsManager(Cmd):
     def do_remove(self, names):
         """Remove source(s).
         Usage: `remove name1 [name2 [name3]]...` or `rm name1 [name2 [name3]]...`\n"""
-        self.sources = [src for src in self.sources if src['name'] not in names]
+        with self._update_config() as state:
+            self.sources = [src for src in self.sources if src['name'] not in names]
+            self.current = [n for n in self.current if n not in names]
+            for name in names:
+                state.get('meta', {}).pop(name, None)
         data_dirs = [os.path.join(self.app_root, 'data', name) for name in names]
         for d in data_dirs:
             self.rmdir(d)
 
 
-    @p.parameter(name='old_name', required=True, validator=(p.Choice, p.FromObj(get_all_names)))
+    @p.parameter(name='old_name', required=True, validator=(p.NameChoice, p.FromObj(get_all_names)))
     @p.parameter(name='new_name', required=True)
     @p.parameter_over()
     def do_rename(self, old_name, new_name):
         """Rename a source.
         Usage: `rename old_name new_name`.\n"""
-        all_names = self.get_all_names()
-        self.sources[all_names.index(old_name)]['name'] = new_name
-        if old_name == self.current:
-            self.current = new_name
+        with self._update_config() as state:
+            all_names = self.get_all_names()
+            self.sources[all_names.index(old_name)]['name'] = new_name
+            self.current = [new_name if n == old_name else n for n in self.current]
+            if old_name in self.versions:
+                self.versions[new_name] = self.versions.pop(old_name)
+            meta = state.get('meta', {})
+            if old_name in meta:
+                meta[new_name] = meta.pop(old_name)
         old_data_dir = os.path.join(self.app_root, 'data', old_name)
         new_data_dir = os.path.join(self.app_root, 'data', new_name)
         if os.path.isdir(old_data_dir):
@@ -166,7 +345,7 @@ class HostsManager(Cmd):
         # print('Renamed "%s" to "%s"\n' %(old_name, new_name))
 
 
-    @p.parameter(name='name', required=True, validator=(p.Choice, p.FromObj(get_all_names)))
+    @p.parameter(name='name', required=True, validator=(p.NameChoice, p.FromObj(get_all_names)))
     @p.parameter(name='order', required=True, validator=p.Regex(r'[+-]?\d+'))
     @p.parameter_over()
     def do_reorder(self, name, order):
@@ -177,13 +356,14 @@ class HostsManager(Cmd):
             relative order is a number with leading "+" or "-": "+" means moving backward and "-" means forward.
         Example: `reorder src1 5` moves src1 to the 5th position.
             `reorder src1 +2` moves src1 backward by 2 positions.\n"""
-        all_names = self.get_all_names()
-        current_order = all_names.index(name)
-        new_order = int(order)-1 if order.isdigit() else eval(str(current_order)+order)
-        new_order = min(max(0, new_order), len(all_names)-1)
-        to_reorder = self.sources[current_order]
-        self.sources.remove(to_reorder)
-        self.sources.insert(new_order, to_reorder)
+        with self._update_config():
+            all_names = self.get_all_names()
+            current_order = all_names.index(name)
+            new_order = int(order)-1 if order.isdigit() else eval(str(current_order)+order)
+            new_order = min(max(0, new_order), len(all_names)-1)
+            to_reorder = self.sources[current_order]
+            self.sources.remove(to_reorder)
+            self.sources.insert(new_order, to_reorder)
         # print('Reordered "%s" to the %dth position\n' %(name, new_order+1))
 
 
@@ -191,43 +371,308 @@ class HostsManager(Cmd):
     def do_pull(self, names):
         """Pull source(s) from remote.
         Usage: `pull [name1 [name2 [name3]]]...`
-        If `name1` not specified, then pull current source.
-        `pull *` will pull all sources.\n"""
+        If `name1` not specified, then pull current source(s).
+        `pull *` will pull all sources.
+            Sources are pulled concurrently by at most `pull_workers` threads (see `settings` in data/config.json).
+            `connect_timeout` and `read_timeout` can be set globally or per source.
+            A source whose `url` is a list of mirrors tries the fastest healthy mirror first and fails over
+            to the others; `pull_retries` and `race_mirrors` can be set globally or per source.\n"""
+        from util.updator import pull_many, format_pull_summary
         if not names:
-            names = [self.current]
-        elif '*' in names:
+            names = list(self.current)
+        elif set(names) & set(p.ALL_ALIASES):
             names = self.get_all_names()
-        for name in names:
-            to_pull = self._get_source_by_name(name)
-            updator = HostsUpdator(to_pull['name'], to_pull['url'], self.app_root)
-            updator.pull()
+        updators = [self._make_updator(self._get_source_by_name(name)) for name in names]
+        start = time.time()
+        results = pull_many(updators, workers=self.settings['pull_workers'])
+        if len(results) > 1:
+            print(format_pull_summary(results, time.time() - start))
+        self._index_updated(results)
+        if [r for r in results if r['status'] == 'failed']:
+            self.exit_code = EXIT_FAILURE
+
+
+    @p.parameter_vary(name='name', validator=(p.VersionedChoice, p.FromObj(get_use_choices)))
+    def do_use(self, names):
+        """Switch to specified source(s).
+        Usage: `use name1 [name2 [name3]]... [-p]` or `use name1 [name2 [name3]]... [--pull]`.
+            `name`: source name(s) to switch to. `use *` uses all sources.
+            `name@version` installs a saved version of the source (see `history`), where version is
+            the version number or a prefix of its md5. The next `use` without a version installs the latest.
+            `-p` or `--pull`: pull from the source(s) before switch.
+            Multiple sources are merged in the order shown by `list` (see `reorder`):
+            a hostname mapped by an earlier source overrides later ones, duplicates are dropped.
+            Hostnames matching `deny` rules of `filters` (in `settings` or in a source) are not installed,
+            nor are hostnames matching no `allow` rule when `allow` is given. A rule is a hostname,
+            a suffix such as `*.example.com`, or a regex such as `/^ads?\\./`.\n"""
+        from util.updator import pull_many
+        is_pull = bool(set(names) & set(['-p', '--pull']))
+        names = [n for n in names if n not in ('-p', '--pull')]
+        all_names = self.get_all_names()
+        if set(names) & set(p.ALL_ALIASES):
+            names = all_names
+        if not names:
+            p.Validator().required_message('name')
+            return False
+        # name@version 指定历史版本，同一个源出现多次时以最后一次为准
+        versions = dict(n.split('@', 1) if '@' in n else (n, None) for n in names)
+        names = sorted(versions, key=all_names.index)
+        updators = [self._make_updator(self._get_source_by_name(name)) for name in names]
+        to_pull = [u for u in updators if is_pull or not (versions[u.name] or u.has_cache())]
+        results = []
+        if to_pull:
+            results = pull_many(to_pull, workers=self.settings['pull_workers'])
+            failed = [r['name'] for r in results if r['status'] == 'failed']
+            if failed:
+                print('*** Failed pulling source(s): %s. Switching canceled.\n' %', '.join(failed))
+                self.exit_code = EXIT_FAILURE
+                return
+        for u in updators:
+            u.version = versions[u.name]
+            if u.version is not None:
+                try:
+                    u.history().find(u.version)
+                except Exception as e:
+                    print('*** Source [%s]: %s. Switching canceled.\n' %(u.name, e))
+                    self.exit_code = EXIT_FAILURE
+                    return
+        updators[0].use(merge_with=updators[1:])
+        with self._update_config():
+            self.current = names
+            self.versions = dict((n, v) for n, v in versions.items() if v is not None)
+        self._index_updated(results)
+        # print('%ssed hosts from source %s\n' %('Pulled and u' if is_pull else 'U', ', '.join(names)))
+
+
+    @p.parameter(name='name', required=True, validator=(p.NameChoice, p.FromObj(get_all_names)))
+    @p.parameter(name='extra', validator=p.Choice(['-a', '--all']))
+    @p.parameter_over()
+    def do_diff(self, name, is_all):
+        """Show hostnames added, removed or changed by the last pull of a source.
+        Usage: `diff name [-a]`.
+            Only the first 20 hostnames of each kind are shown, use `-a` or `--all` to show all.\n"""
+        updator = self._make_updator(self._get_source_by_name(name))
+        try:
+            added, removed, changed = updator.diff()
+        except Exception as e:
+            print('*** %s\n' %e)
+            self.exit_code = EXIT_FAILURE
+            return
+        limit = None if is_all else DIFF_LIMIT
+        for title, lead, items in (('added', '+', added), ('removed', '-', removed), ('changed', '~', changed)):
+            print('%d hostname(s) %s:' %(len(items), title))
+            for item in sorted(items)[:limit]:
+                print('  %s %s\t%s' %(lead, item[0], ' -> '.join(item[1:])))
+            if limit is not None and len(items) > limit:
+                print('  ... %d more' %(len(items) - limit))
+        print('')
+
+
+    # 打开主机名索引，并为 md5 变化的源重建索引（例如由旧版本拉取的缓存）
+    def _open_index(self):
+        import sqlite3
+        from util.lookup import LookupIndex
+        from util.filelock import LockTimeout
+        index = LookupIndex(self.app_root, self.settings['lock_timeout'])
+        try:
+            index.sync([self._make_updator(src) for src in self.sources])
+        except (sqlite3.Error, LockTimeout, IOError, OSError) as e:
+            # 没有写权限时仍可查询已有的索引
+            print('*** Warning: failed updating hostname index, results may be stale: %s\n' %e)
+        return index
 
 
-    @p.parameter(name='name', required=True, validator=(p.Choice, p.FromObj(get_all_names)))
-    @p.parameter(name='extra', validator=p.Choice(['-p', '--pull']))
+    # 输出 (hostname, source, ip, line) 列表；正在使用的源以 "*" 标记，同一主机名按源的顺序排列
+    def _print_mappings(self, rows):
+        order = dict((name, i) for i, name in enumerate(self.get_all_names()))
+        rows = sorted(rows, key=lambda r: (r[0], order.get(r[1], len(order)), r[3]))
+        for hostname, source, ip, line in rows:
+            lead = '*' if source in self.current else ' '
+            print('{lead} {hostname}\t{ip}\t{source}:{line}'.format(
+                lead=lead, hostname=hostname, ip=ip, source=source, line=line))
+
+
+    @p.parameter(name='hostname', required=True)
+    @p.parameter_over()
+    def do_which(self, hostname):
+        """Show which pulled sources map a hostname, with the IP and line number in each source.
+        Usage: `which hostname`. Sources in use are marked with "*".\n"""
+        index = self._open_index()
+        try:
+            rows = index.which(hostname)
+        finally:
+            index.close()
+        if not rows:
+            print('Hostname "%s" is not mapped by any pulled source.\n' %hostname)
+            self.exit_code = EXIT_FAILURE
+            return
+        self._print_mappings([(hostname.lower(),) + tuple(r) for r in rows])
+        print('')
+
+
+    @p.parameter(name='pattern', required=True)
+    @p.parameter(name='extra', validator=p.Choice(['-a', '--all']))
+    @p.parameter_over()
+    def do_grep(self, pattern, is_all):
+        """Search hostnames of all pulled sources.
+        Usage: `grep pattern [-a]`.
+            `pattern`: a substring such as `google`, or a wildcard pattern such as `*.google.com`, `ads.*` or `a?.b*`.
+            Only the first 50 hostnames are shown, use `-a` or `--all` to show all.
+            Hostnames are looked up in an index, sources are not scanned after they are indexed.\n"""
+        limit = None if is_all else GREP_LIMIT
+        index = self._open_index()
+        try:
+            # 多取一个用于判断是否还有更多结果
+            rows = index.search(pattern, None if limit is None else limit + 1)
+        finally:
+            index.close()
+        hostnames = sorted(set(r[0] for r in rows))
+        shown = set(hostnames[:limit])
+        self._print_mappings([r for r in rows if r[0] in shown])
+        if limit is not None and len(hostnames) > limit:
+            print('  ... more hostnames matched, use `-a` to show all')
+        if not rows:
+            print('No hostname matches "%s".' %pattern)
+            self.exit_code = EXIT_FAILURE
+        print('')
+
+
+    @p.parameter(name='name', required=True, validator=(p.NameChoice, p.FromObj(get_all_names)))
+    @p.parameter_over()
+    def do_lint(self, name):
+        """Validate the cached hosts of a source: IP and hostname syntax, HTML content,
+        duplicate and conflicting mappings. The same checks except duplicates and conflicts run on every pull
+        while downloading (see `validate_pull`); content that fails them, or shrinks by more than `max_shrink`,
+        does not replace the cache.
+        Usage: `lint name`.\n"""
+        from util.validator import Validator, format_report
+        src = self._get_source_by_name(name)
+        updator = self._make_updator(src)
+        if not updator.has_cache():
+            print('*** No cached hosts for source [%s], pull it first\n' %name)
+            self.exit_code = EXIT_FAILURE
+            return
+        get = lambda key: src.get(key, self.settings[key])
+        report = Validator(get('max_shrink'), get('max_invalid_ratio')).validate(updator.cached_hosts())
+        print(format_report(report))
+        for lineno, reason, line in report['samples']:
+            print('  line %d, %s: %s' %(lineno, reason, line[:100]))
+        for error in report['errors']:
+            print('*** %s' %error)
+        if report['errors']:
+            self.exit_code = EXIT_FAILURE
+        print('')
+
+
+    @p.parameter(name='name', required=True, validator=(p.NameChoice, p.FromObj(get_all_names)))
+    @p.parameter_over()
+    def do_history(self, name):
+        """List saved versions of a source, newest first, with the change of entry count from the previous version.
+        Usage: `history name`. Install one of them with `use name@version`.
+            A version is saved whenever a pull changes the source, the newest `history_keep`
+            (see `settings` in data/config.json) versions are kept, 0 disables history.
+            Older versions are stored as compressed deltas against the next newer one,
+            versions larger than 8 MB as full compressed snapshots.\n"""
+        updator = self._make_updator(self._get_source_by_name(name))
+        history = updator.history()
+        versions = history.versions()
+        if not versions:
+            print('No saved version of source [%s], it is saved on the next pull that changes it.\n' %name)
+            return
+        digest = updator.store.get_meta(name).get('digest')
+        print('  {:<9}{:<21}{:<14}{:>10}{:>9}{:>12}'.format('version', 'time', 'md5', 'entries', 'change', 'size'))
+        previous = [None] + [v['entries'] for v in versions[:-1]]
+        for v, prev in reversed(list(zip(versions, previous))):
+            change = '' if v['entries'] is None or prev is None else '%+d' %(v['entries'] - prev)
+            print('{lead} {:<9}{:<21}{:<14}{:>10}{:>9}{:>12}'.format(v['version'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(v['time'])), v['digest'][:12],
+                '-' if v['entries'] is None else v['entries'], change, v['size'],
+                lead='*' if v['digest'] == digest else ' '))
+        print('%d version(s), %d bytes stored for %d bytes of content.\n'
+            %(len(versions), history.stored_size(), sum(v['size'] for v in versions)))
+
+
+    @p.parameter(name='backup')
     @p.parameter_over()
-    def do_use(self, name, extra):
-        """Switch to specified source.
-        Usage: `use name [-p]` or `use name [--pull]`.
-            `name`: source name to switch to.
-            `-p` or `--pull`: pull from the source before switch.\n"""
-        is_pull = bool(extra)
-        if not is_pull:
-            data_dir = os.path.join(self.app_root, 'data', name)
-            if not os.path.isdir(data_dir):
-                is_pull = True
-        to_use = self._get_source_by_name(name)
-        updator = HostsUpdator(to_use['name'], to_use['url'], self.app_root)
-        if is_pull:
-            updator.pull()
-        updator.use()
-        self.current = name
-        # print('%ssed hosts from source %s\n' %('Pulled and u' if is_pull else 'U', name))
+    def do_restore(self, backup_id):
+        """List backups of system hosts, or restore one of them.
+        Usage: `restore` or `restore backup`.
+            `backup`: backup time (as listed) or a prefix of its md5 digest.
+            Backups are kept under `data/.backups/` according to `backup_keep_last` and `backup_keep_days`.\n"""
+        if not self.sources:
+            print('*** No source added yet, add a source first.\n')
+            self.exit_code = EXIT_FAILURE
+            return
+        updator = self._make_updator(self._get_source_by_name(self.current[0]) if self.current else self.sources[0])
+        if not backup_id:
+            for entry in reversed(updator.backup_store().entries()):
+                print('  {time}\t{digest}\t{size} bytes'.format(**entry))
+            print('')
+            return
+        try:
+            updator.restore(backup_id)
+        except Exception as e:
+            print('*** %s\n' %e)
+            self.exit_code = EXIT_FAILURE
+
+
+    # 守护进程的刷新计划：源自身配置了 refresh_interval 的，以及正在使用的源（使用全局设置）
+    # 间隔为 0 的源不刷新
+    def get_refresh_schedule(self):
+        schedule = {}
+        for src in self.sources:
+            interval = src.get('refresh_interval')
+            if interval is None and src['name'] in self.current:
+                interval = self.settings['refresh_interval']
+            if interval:
+                schedule[src['name']] = interval
+        return schedule
+
+
+    # 守护进程每轮开始前重新读取配置，使其他 hman 进程的 use、add、remove 等修改在下一轮生效
+    def _daemon_config(self):
+        self._reload_config()
+        return {'schedule': self.get_refresh_schedule(), 'current': list(self.current),
+            'versions': dict(self.versions)}
+
+
+    @p.parameter_over()
+    def do_daemon(self):
+        """Keep running, pull sources periodically and reinstall hosts when a source in use changed.
+        Usage: `daemon`, usually run one-shot as `hman.py daemon`. Stop it with Ctrl-C or SIGTERM.
+            Sources in use are refreshed every `refresh_interval` seconds (see `settings` in data/config.json),
+            a source can set its own `refresh_interval` to be refreshed as well, 0 disables it.
+            Intervals are randomized by `refresh_jitter` (a fraction) to avoid pulling all sources at once.
+            data/config.json is re-read before every round, so `use`, `add` and `remove` apply while it runs;
+            a source installed as `name@version` stays at that version until the next `use name`.
+            Use `status` to query the daemon.\n"""
+        from util.daemon import RefreshDaemon
+        if not self.get_refresh_schedule():
+            print('*** No source to refresh, use a source or set `refresh_interval` of some source first.\n')
+            self.exit_code = EXIT_FAILURE
+            return
+        daemon = RefreshDaemon(self.app_root, self._daemon_config,
+            lambda name: self._make_updator(self._get_source_by_name(name)),
+            jitter=self.settings['refresh_jitter'], workers=self.settings['pull_workers'],
+            metrics_log=self.settings['metrics_log'], metrics_textfile=self.settings['metrics_textfile'],
+            index_on_pull=self.settings['index_on_pull'])
+        daemon.run()
+
+
+    @p.parameter_over()
+    def do_status(self):
+        """Show status of the daemon: last pull, last change, next run and failures of each source.
+        Usage: `status`. The status is read from `data/.daemon.json`.\n"""
+        from util.daemon import read_status, format_status
+        status = read_status(self.app_root)
+        if status is None:
+            print('Daemon has never run.\n')
+            return
+        print(format_status(status))
 
 
     def do_exit(self, line):
         """Exit hosts-manager.\n"""
-        self._rewrite_config()
         sys.exit(0)
 
 
@@ -239,26 +684,50 @@ class HostsManager(Cmd):
     complete_pull = complete_name
     complete_rename = complete_ren = complete_name_once
     complete_reorder = complete_name_once
-    complete_use = complete_name_once
+    complete_use = complete_name
+
+
+# 输出 util 中各模块的日志（logger 名称为 HostsUpdator）
+def setup_logging():
+    logger = logging.getLogger('HostsUpdator')
+    logger.setLevel(logging.INFO)
+    hd = logging.StreamHandler()
+    hd.setFormatter(logging.Formatter(fmt='[%(asctime)s]:%(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    logger.addHandler(hd)
+
+
+# `--profile` 在 cProfile 和 tracemalloc 下执行，统计结果保存在 data/profile/ 中
+def main(argv):
+    setup_logging()
+    args = [a for a in argv[1:] if a != '--profile']
+    if len(args) < len(argv) - 1:
+        from util import metrics
+        app_root = os.path.dirname(os.path.abspath(__file__))
+        return metrics.profile(lambda: run(args), os.path.join(app_root, 'data', 'profile'),
+            label=args[0] if args else 'cli')
+    return run(args)
+
+
+def run(args):
+    if not (args and args[0] in READ_ONLY_COMMANDS):
+        from util import admin
+        if os.name == 'nt':
+            if not admin.is_admin_nt():
+                print('\n*** Need administrator privileges!\nInstead of Requesting UAC elevation from within the script?, we recommand runing as admin from the very begining.\n')
+                return admin.run_as_admin() or EXIT_OK
+        elif os.name == 'posix':
+            if not admin.is_admin_posix():
+                print('\n*** Need root privileges!\nUse `sudo python hman.py` to run the script as root.\n')
+                return EXIT_FAILURE if args else EXIT_OK
+        else:
+            raise RuntimeError('Unsupported operating system: %s' %(os.name,))
 
+    hman = HostsManager()
+    # 带参数时执行一条命令后退出，例如 `hman.py pull '*'`
+    if args:
+        return hman.run_once(args)
+    hman.cmdloop()
 
-if __name__ == '__main__':
-    from util import admin
-    if os.name == 'nt':
-        if not admin.is_admin_nt():
-            print('\n*** Need administrator privileges!\nInstead of Requesting UAC elevation from within the script?, we recommand runing as admin from the very begining.\n')
-            admin.run_as_admin()
-            exit(0)
-    elif os.name == 'posix':
-        if not admin.is_admin_posix():
-            print('\n*** Need root privileges!\nUse `sudo python hman.py` to run the script as root.\n')
-            exit(0)
-    else:
-        raise RuntimeError('Unsupported operating system: %s' %(os.name,))
 
-    hman = HostsManager()
-    try:
-        hman.cmdloop()
-    except Exception as e:
-        hman._rewrite_config()
-        raise
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.encoding import Utf8Normalizer, SNIFF_SIZE
+
+
+def normalize(data, chunk_size=None):
+    normalizer = Utf8Normalizer()
+    chunk_size = chunk_size or len(data) or 1
+    out = b''.join(normalizer.feed(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size))
+    return (out + normalizer.finish()).decode('utf8'), normalizer.encoding
+
+
+class Utf8NormalizerTest(unittest.TestCase):
+
+    # 这些 gbk 字符的字节恰好也是合法的 utf-8 双字节序列
+    def test_gbk_that_starts_as_valid_utf8(self):
+        for text in (u'# 注释\n0.0.0.0 a.com\n', u'# 说明\n0.0.0.0 a.com\n'):
+            for chunk_size in (None, 1, 3, 7):
+                self.assertEqual(normalize(text.encode('gbk'), chunk_size), (text, 'gbk'))
+
+    def test_utf8(self):
+        text = u'# 注释\r\n0.0.0.0 a.com\r\n'
+        self.assertEqual(normalize(text.encode('utf8'), 5), (text.replace('\r\n', '\n'), 'utf-8'))
+
+    def test_bom(self):
+        text = u'# 注释\n0.0.0.0 a.com\n'
+        self.assertEqual(normalize(b'\xff\xfe' + text.encode('utf-16-le'), 4), (text, 'utf-16-le'))
+
+    # 超过判断窗口后才出现的非法字节被替换，不再改变编码
+    def test_invalid_bytes_after_sniff_window(self):
+        data = u'# 注释\n'.encode('utf8') + b'0' * 2 * SNIFF_SIZE + b'\n\xff\n'
+        text, encoding = normalize(data, 4096)
+        self.assertEqual(encoding, 'utf-8 (with replaced bytes)')
+        self.assertTrue(text.startswith(u'# 注释\n') and text.endswith(u'\n�\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
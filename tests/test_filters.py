@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.filters import HostsFilter, RuleSet, NOT_ALLOWED
+
+
+class RuleSetTest(unittest.TestCase):
+
+    def test_match(self):
+        rules = RuleSet([u'ads.com', u'*.tracker.net', u'/^ad[sx]?\\d+\\./'])
+        self.assertEqual(rules.match(u'ads.com'), u'ads.com')
+        self.assertEqual(rules.match(u'a.b.tracker.net'), u'*.tracker.net')
+        self.assertEqual(rules.match(u'ad1.example.com'), u'/^ad[sx]?\\d+\\./')
+        # 后缀规则只匹配子域名，不匹配自身
+        self.assertIsNone(rules.match(u'tracker.net'))
+        self.assertIsNone(rules.match(u'x.ads.com'))
+
+    def test_invalid_regex(self):
+        self.assertRaises(ValueError, RuleSet, [u'/(/'])
+
+
+class HostsFilterTest(unittest.TestCase):
+
+    def test_deny(self):
+        f = HostsFilter(deny=[u'*.ads.com'])
+        lines = [u'# c\n', u'1.1.1.1 a.ads.com\n', u'1.1.1.1 b.ads.com ok.com # x\n', u'2.2.2.2 ok.net\n']
+        self.assertEqual(list(f.filter_lines(lines)), [u'# c\n', u'1.1.1.1 ok.com # x\n', u'2.2.2.2 ok.net\n'])
+        self.assertEqual(f.dropped, {u'*.ads.com': 2})
+
+    # deny 优先于 allow；给出 allow 时，不匹配任何 allow 规则的主机名被丢弃
+    def test_allow(self):
+        f = HostsFilter(allow=[u'*.google.com'], deny=[u'ads.google.com'])
+        lines = [u'1.1.1.1 www.google.com ads.google.com\n', u'2.2.2.2 other.com\n']
+        self.assertEqual(list(f.filter_lines(lines)), [u'1.1.1.1 www.google.com\n'])
+        self.assertEqual(f.dropped, {u'ads.google.com': 1, NOT_ALLOWED: 1})
+
+    def test_empty(self):
+        self.assertFalse(HostsFilter())
+        self.assertTrue(HostsFilter(deny=[u'a.com']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import history
+from util.history import SourceHistory, make_delta, apply_delta, write_delta
+from util.fsutil import file_md5
+
+VERSIONS = [
+    b''.join(b'0.0.0.0 host%d.example.com\n' %i for i in range(200)),
+    b'# header\n' + b''.join(b'0.0.0.0 host%d.example.com\n' %i for i in range(0, 200, 2)),
+    b'# header\n' + b''.join(b'0.0.0.0 host%d.example.com\n' %i for i in range(100, 300)),
+    b'',
+]
+
+
+class DeltaTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for base in VERSIONS:
+            for target in VERSIONS:
+                f = io.BytesIO()
+                write_delta(f, make_delta(target.splitlines(True), base.splitlines(True)))
+                f.seek(0)
+                self.assertEqual(b''.join(apply_delta(target.splitlines(True), f)), base)
+
+
+class SourceHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, store, data, now):
+        path = os.path.join(self.tmp_dir, 'hosts.txt')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return store.add(path, file_md5(path), data.count(b'\n'), now=now)
+
+    # 只有最新版本是完整快照，更早的版本沿增量链还原
+    def test_chain(self):
+        store = SourceHistory(self.tmp_dir)
+        for i, data in enumerate(VERSIONS):
+            self.assertEqual(self.add(store, data, i)['version'], i + 1)
+        self.assertIsNone(self.add(store, VERSIONS[-1], 99))
+        objects = store.read_manifest()['objects']
+        self.assertEqual(sorted(base is None for base in objects.values()), [False] * 3 + [True])
+        for i, data in enumerate(VERSIONS):
+            digest = store.find(i + 1)['digest']
+            self.assertEqual(store.find(digest[:history.MIN_DIGEST_PREFIX])['version'], i + 1)
+            self.assertEqual(u''.join(store.iter_lines(i + 1)), data.decode('utf8'))
+            with open(store.checkout(i + 1), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertRaises(Exception, store.find, 'nope')
+
+    # 超出 keep 的旧版本及不再需要的对象被删除
+    def test_prune(self):
+        store = SourceHistory(self.tmp_dir, keep=2)
+        for i, data in enumerate(VERSIONS):
+            self.add(store, data, i)
+        self.assertEqual([v['version'] for v in store.versions()], [3, 4])
+        stored = set(n for n in os.listdir(store.root) if n.endswith(history.FULL_SUFFIX))
+        self.assertEqual(len(stored), 2)
+        with open(store.checkout(3), 'rb') as f:
+            self.assertEqual(f.read(), VERSIONS[2])
+
+    # 再次出现的旧内容成为新的最新版本，改为完整存储
+    def test_repeated_content(self):
+        store = SourceHistory(self.tmp_dir)
+        for i, data in enumerate([VERSIONS[0], VERSIONS[1], VERSIONS[0]]):
+            self.add(store, data, i)
+        self.assertEqual(len(store.versions()), 3)
+        for version, data in ((1, VERSIONS[0]), (2, VERSIONS[1]), (3, VERSIONS[0])):
+            self.assertEqual(u''.join(store.iter_lines(version)), data.decode('utf8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
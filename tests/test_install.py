@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import stat
+import errno
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import updator
+from util.store import ConfigStore
+
+RENDERED = b'127.0.0.1 localhost\n' + updator.SEPARATOR.encode('utf8') + b'\n0.0.0.0 ads.example.com\n'
+
+
+class InstallTest(unittest.TestCase):
+    """Installs into a temporary directory, never into the system hosts."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hosts_file = os.path.join(self.tmp_dir, 'hosts')
+        self.rendered = os.path.join(self.tmp_dir, 'rendered.hosts')
+        with open(self.rendered, 'wb') as f:
+            f.write(RENDERED)
+        with open(self.hosts_file, 'wb') as f:
+            f.write(b'127.0.0.1 localhost\n' * 50)
+        os.chmod(self.hosts_file, 0o640)
+        self.updator = updator.HostsUpdator('test', 'http://127.0.0.1/hosts', self.tmp_dir,
+            store=ConfigStore(self.tmp_dir), verify_install=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_hosts(self):
+        with open(self.hosts_file, 'rb') as f:
+            return f.read()
+
+    # 整体替换：内容一致，保留原有的权限，不留下临时文件
+    def test_atomic(self):
+        inode = os.stat(self.hosts_file).st_ino
+        self.updator.install(self.rendered, self.hosts_file)
+        self.assertEqual(self.read_hosts(), RENDERED)
+        self.assertEqual(stat.S_IMODE(os.stat(self.hosts_file).st_mode), 0o640)
+        self.assertNotEqual(os.stat(self.hosts_file).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['hosts', 'rendered.hosts'])
+
+    def test_verification(self):
+        with open(self.rendered, 'wb') as f:
+            f.write(b'0.0.0.0 no.separator\n')
+        self.assertRaises(Exception, self.updator.install, self.rendered, self.hosts_file)
+        self.assertEqual(self.read_hosts(), b'127.0.0.1 localhost\n' * 50)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['hosts', 'rendered.hosts'])
+
+    # hosts 是挂载点而无法替换时，原地写入同一个文件
+    def test_in_place_fallback(self):
+        def replace_file(src, dst):
+            raise OSError(errno.EBUSY, 'Device or resource busy')
+        replace = updator.replace_file
+        updator.replace_file = replace_file
+        try:
+            inode = os.stat(self.hosts_file).st_ino
+            self.updator.install(self.rendered, self.hosts_file)
+        finally:
+            updator.replace_file = replace
+        self.assertEqual(self.read_hosts(), RENDERED)
+        self.assertEqual(os.stat(self.hosts_file).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['hosts', 'rendered.hosts'])
+
+    def test_other_errors_propagate(self):
+        def replace_file(src, dst):
+            raise OSError(errno.EACCES, 'Permission denied')
+        replace = updator.replace_file
+        updator.replace_file = replace_file
+        try:
+            self.assertRaises(OSError, self.updator.install, self.rendered, self.hosts_file)
+        finally:
+            updator.replace_file = replace
+        self.assertEqual(self.read_hosts(), b'127.0.0.1 localhost\n' * 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
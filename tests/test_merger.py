@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import merger
+
+
+def merge(sources):
+    out = io.StringIO()
+    stats = merger.merge([(name, text.splitlines(True)) for name, text in sources], out)
+    return out.getvalue(), stats
+
+
+class MergeTest(unittest.TestCase):
+
+    def test_first_source_wins(self):
+        text, stats = merge([
+            (u'a', u'1.1.1.1 x.com y.com\n'),
+            (u'b', u'1.1.1.1 x.com\n2.2.2.2 y.com z.com\n'),
+        ])
+        self.assertEqual(text, u''.join([
+            merger.SOURCE_HEADER.format(name=u'a'), u'1.1.1.1 x.com y.com\n',
+            merger.SOURCE_HEADER.format(name=u'b'), u'2.2.2.2 z.com\n',
+        ]))
+        self.assertEqual(stats, [
+            {'name': u'a', 'entries': 2, 'duplicates': 0, 'conflicts': 0},
+            {'name': u'b', 'entries': 1, 'duplicates': 1, 'conflicts': 1},
+        ])
+
+    # 同一主机名可以同时有 IPv4 和 IPv6 映射
+    def test_ipv4_and_ipv6_are_separate(self):
+        text, stats = merge([(u'a', u'1.1.1.1 x.com\n'), (u'b', u'::1 x.com\n')])
+        self.assertIn(u'::1 x.com\n', text)
+        self.assertEqual(stats[1]['conflicts'], 0)
+
+    # 注释、空行原样保留，缺少换行符的最后一行补上换行符，部分保留的行保留行尾注释
+    def test_keeps_comments_and_blank_lines(self):
+        text, stats = merge([(u'a', u'1.1.1.1 x.com\n'), (u'b', u'# note\n\n2.2.2.2 X.com y.com # c')])
+        self.assertTrue(text.endswith(u'# note\n\n2.2.2.2 y.com # c\n'), text)
+        self.assertEqual(stats[1]['entries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.parser import EntryCounter
+from util.validator import Validator
+
+LINES = [
+    u'# comment', u'', u'   ', u'0.0.0.0 a.com', u'127.0.0.1 localhost loc.al # x', u'::1 ip6-localhost',
+    u'fe80::1%lo0 x.y', u'999.1.1.1 bad.ip', u'1.2.3.4', u'1.2.3.4 # only', u'1.2.3.4 bad!host',
+    u'1.2.3.4 ' + u'a' * 64 + u'.com', u'1.2.3.4 ' + (u'a' * 60 + u'.') * 5, u'1.2.3.4 -x.com', u'1.2.3.4 x-.com',
+    u'\t1.2.3.4\tA.COM\t', u'1.2.3.4 ok.com. ', u'1.2.3.4 ok..com', u'1.2.3.4 .ok.com', u'1.2.3.4 中文.com',
+    u'junk', u'1.2.3.4 x.com#c', u'1.2.3.4 x.com y_z.com', u'ABCD::EF01 up.case',
+]
+
+
+def stream(data, chunk_size, previous_entries=None):
+    checker = Validator().stream(previous_entries)
+    counter = EntryCounter()
+    for i in range(0, len(data), chunk_size):
+        checker.feed(data[i:i + chunk_size])
+        counter.feed(data[i:i + chunk_size])
+    return checker.finish(), counter.finish()
+
+
+class ContentCheckerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def validate(self, data, previous_entries=None):
+        path = os.path.join(self.tmp_dir, 'hosts.txt')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return Validator().validate(path, previous_entries)
+
+    # 流式校验与逐行校验的结果一致，无论内容如何分块
+    def test_same_as_validate(self):
+        for i, line in enumerate(LINES):
+            body = u'\n'.join(LINES[i:] + LINES[:i] + [u'0.0.0.0 host%d.example.com' %n for n in range(50)])
+            for data in (body.encode('utf8'), (body + u'\n').encode('utf8')):
+                expected = self.validate(data, 100)
+                for chunk_size in (1, 7, 64, len(data)):
+                    report, _ = stream(data, chunk_size, 100)
+                    for key in ('lines', 'entries', 'malformed', 'invalid_ip', 'invalid_hostname', 'html', 'errors'):
+                        self.assertEqual(report[key], expected[key], (key, line, chunk_size))
+
+    def test_each_bad_line_is_reported(self):
+        good = u''.join(u'0.0.0.0 host%d.example.com\n' %n for n in range(1000))
+        for line in LINES:
+            expected = self.validate((good + line + u'\n').encode('utf8'))
+            report, _ = stream((good + line + u'\n').encode('utf8'), 4096)
+            self.assertEqual(report['samples'], expected['samples'], line)
+            self.assertEqual(report['entries'], expected['entries'], line)
+            self.assertEqual(report['duplicates'], None)
+
+    def test_html(self):
+        report, count = stream(b'<!DOCTYPE html>\n<html><body>error</body></html>\n', 5)
+        self.assertTrue(report['html'])
+        self.assertTrue(report['errors'])
+        self.assertEqual(count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import shutil
+import tempfile
+
+from util.fsutil import replace_file, file_md5
+
+BACKUP_DIR = '.backups'
+MANIFEST_NAME = 'manifest.json'
+TIME_FORMAT = '%Y%m%d.%H%M%S'
+
+
+class BackupStore(object):
+    """Content-addressed hosts backups under `data/.backups/`.
+    Each distinct content is stored once as `<md5>.bak`, `manifest.json` records
+    when each backup was taken, newest last.\n"""
+    def __init__(self, app_root, keep_last=10, keep_days=7):
+        self.root = os.path.join(app_root, 'data', BACKUP_DIR)
+        self.manifest_file = os.path.join(self.root, MANIFEST_NAME)
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest + '.bak')
+
+    # 读取备份清单，每项为 {'time', 'digest', 'size'}，按时间先后排列
+    def entries(self):
+        if not os.path.isfile(self.manifest_file):
+            return []
+        with open(self.manifest_file, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                return []
+
+    def _write_entries(self, entries):
+        fd, tmp_file = tempfile.mkstemp(prefix='.manifest.', suffix='.tmp', dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f, indent=4, sort_keys=True)
+        replace_file(tmp_file, self.manifest_file)
+
+    # 备份文件，内容已存在时只记录清单而不重复保存；与最近一次备份相同时只更新时间
+    def add(self, path, now=None):
+        now = time.time() if now is None else now
+        digest = file_md5(path)
+        blob = self.blob_path(digest)
+        if not os.path.isfile(blob):
+            tmp_file = blob + '.tmp'
+            shutil.copyfile(path, tmp_file)
+            replace_file(tmp_file, blob)
+        entries = self.entries()
+        entry = {'time': time.strftime(TIME_FORMAT, time.localtime(now)),
+            'digest': digest, 'size': os.path.getsize(blob)}
+        if entries and entries[-1]['digest'] == digest:
+            entries[-1] = entry
+        else:
+            entries.append(entry)
+        self._write_entries(self.prune(entries, now))
+        return entry
+
+    # 按保留策略清理：保留最近 keep_last 个，以及最近 keep_days 天中每天最新的一个
+    # 不再被任何备份引用的内容文件会被删除
+    def prune(self, entries, now=None):
+        now = time.time() if now is None else now
+        keep = set(range(max(0, len(entries) - self.keep_last), len(entries)))
+        earliest = time.strftime('%Y%m%d', time.localtime(now - self.keep_days * 86400))
+        days = set()
+        for i in range(len(entries) - 1, -1, -1):
+            day = entries[i]['time'][:8]
+            if day > earliest and day not in days:
+                days.add(day)
+                keep.add(i)
+        kept = [e for i, e in enumerate(entries) if i in keep]
+        referenced = set(e['digest'] for e in kept)
+        for name in os.listdir(self.root):
+            if name.endswith('.bak') and name[:-len('.bak')] not in referenced:
+                os.remove(os.path.join(self.root, name))
+        return kept
+
+    # 按时间或内容 md5（前缀）查找备份，找不到或有歧义时抛出异常
+    def find(self, backup_id):
+        entries = self.entries()
+        matched = [e for e in entries if e['time'] == backup_id]
+        if not matched:
+            matched = dict((e['digest'], e) for e in entries if e['digest'].startswith(backup_id)).values()
+            matched = list(matched)
+        if not matched:
+            raise Exception('Backup "%s" not found' %backup_id)
+        if len(matched) > 1:
+            raise Exception('Backup "%s" is ambiguous, use a longer digest prefix' %backup_id)
+        return matched[0]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 请求时声明支持的传输压缩格式
+ACCEPT_ENCODING = 'gzip, deflate'
+
+CACHE_NAME = 'hosts.txt'
+
+# 本地缓存格式：格式名 -> 文件后缀，'' 表示不压缩
+CACHE_FORMATS = {
+    '': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class DecodedResponse(object):
+    """File-like wrapper that decodes a gzip/deflate encoded HTTP response on the fly.
+    `transferred` counts the raw bytes read from the network.\n"""
+    def __init__(self, response, encoding):
+        self.response = response
+        self.encoding = (encoding or '').strip().lower()
+        self.transferred = 0
+        self._decoder = None
+        self._first = True
+        if self.encoding in ('gzip', 'x-gzip', 'deflate'):
+            # 32 + MAX_WBITS 自动识别 gzip 和 zlib 头
+            self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        elif self.encoding not in ('', 'identity'):
+            raise ValueError('Unsupported content encoding: %s' %self.encoding)
+
+    def read(self, size):
+        while True:
+            raw = self.response.read(size)
+            self.transferred += len(raw)
+            if self._decoder is None:
+                return raw
+            if not raw:
+                return self._decoder.flush()
+            try:
+                data = self._decoder.decompress(raw)
+            except zlib.error:
+                # 部分服务器的 deflate 响应不带 zlib 头，退回到原始 deflate 流
+                if not (self._first and self.encoding == 'deflate'):
+                    raise
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = self._decoder.decompress(raw)
+            self._first = False
+            if data:
+                return data
+
+    def info(self):
+        return self.response.info()
+
+    def close(self):
+        self.response.close()
+
+
+def check_cache_format(fmt):
+    if fmt not in CACHE_FORMATS:
+        raise ValueError('Unknown cache format "%s", must be one of %s' %(fmt, sorted(CACHE_FORMATS)))
+    if fmt == 'zstd' and zstandard is None:
+        raise ValueError('Cache format "zstd" requires the `zstandard` package')
+
+
+def cache_path(working_dir, fmt=''):
+    return os.path.join(working_dir, CACHE_NAME + CACHE_FORMATS[fmt])
+
+
+# 查找源的数据目录中已有的缓存文件，不存在则返回 None
+def find_cache(working_dir):
+    for fmt in sorted(CACHE_FORMATS):
+        path = cache_path(working_dir, fmt)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+# 删除除 keep 之外其他格式的缓存文件
+def remove_stale_caches(working_dir, keep):
+    for fmt in CACHE_FORMATS:
+        path = cache_path(working_dir, fmt)
+        if path != keep and os.path.isfile(path):
+            os.remove(path)
+
+
+def _format_of(path):
+    for fmt, suffix in CACHE_FORMATS.items():
+        if suffix and path.endswith(suffix):
+            return fmt
+    return ''
+
+
+# 以二进制模式打开缓存文件用于写入，fmt 指定压缩格式
+def open_write(path, fmt=''):
+    if fmt == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if fmt == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+# 以二进制模式打开缓存文件用于读取，根据后缀自动解压
+def open_read(path):
+    fmt = _format_of(path)
+    if fmt == 'gzip':
+        return gzip.open(path, 'rb')
+    if fmt == 'zstd':
+        if zstandard is None:
+            raise ValueError('Reading "%s" requires the `zstandard` package' %path)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return open(path, 'rb')
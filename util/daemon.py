@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import json
+import random
+import signal
+import logging
+import tempfile
+
+from util import mirrors
+from util import metrics
+from util.fsutil import replace_file
+from util.updator import pull_many, index_sources, PULL_WORKERS
+
+STATUS_NAME = '.daemon.json'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# 默认的刷新间隔（秒）和随机抖动的比例
+REFRESH_INTERVAL = 6 * 3600
+REFRESH_JITTER = 0.1
+# 拉取失败后提前重试，等待时间从 FAILURE_BACKOFF 秒开始指数增长，不超过源的刷新间隔
+FAILURE_BACKOFF = 60
+
+logger = logging.getLogger('HostsUpdator')
+
+
+def status_file(app_root):
+    return os.path.join(app_root, 'data', STATUS_NAME)
+
+
+# 读取守护进程的状态文件，不存在时返回 None
+def read_status(app_root):
+    try:
+        with open(status_file(app_root), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def format_time(t):
+    return time.strftime(TIME_FORMAT, time.localtime(t)) if t else '-'
+
+
+# 格式化状态，用于 `status` 命令
+def format_status(status):
+    pid_state = 'running' if status['state'] == 'running' and pid_alive(status['pid']) else 'stopped'
+    lines = ['Daemon %s (pid %d), started %s, last install %s.' %(pid_state, status['pid'],
+        format_time(status['started']), format_time(status['last_install']))]
+    lines.append('{:<16}{:<14}{:<21}{:<21}{:<21}{:>9}'.format(
+        'name', 'status', 'last pull', 'last change', 'next run', 'failures'))
+    for name, s in sorted(status['sources'].items()):
+        lines.append('{:<16}{:<14}{:<21}{:<21}{:<21}{:>9}'.format(name, s['last_status'] or '-',
+            format_time(s['last_pull']), format_time(s['last_change']), format_time(s['next_run']), s['failures']))
+        if s['last_error']:
+            lines.append('    error: %s' %s['last_error'])
+    return '\n'.join(lines) + '\n'
+
+
+# Windows 上 os.kill 会结束目标进程，无法用来探测，只能信任状态文件
+def pid_alive(pid):
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM 表示进程存在但属于其他用户
+        return e.errno == errno.EPERM
+    return True
+
+
+class RefreshDaemon(object):
+    """Periodically pulls sources and reinstalls the hosts in use when one of them changed.
+
+    `load_config` is called before every round and returns a dict of `schedule` (source names
+    to their refresh interval in seconds), `current` (the names in use) and `versions` (the saved
+    versions installed by `use name@version`, kept as they are). `make_updator` creates a
+    HostsUpdator for a source name.
+    Status is written to `data/.daemon.json` after every round, and metrics are
+    exported to `metrics_log` and `metrics_textfile` (see util/metrics.py).
+    Changed sources are reindexed for which/grep after the install when `index_on_pull` is set.\n"""
+    def __init__(self, app_root, load_config, make_updator, jitter=REFRESH_JITTER, workers=PULL_WORKERS,
+            metrics_log='', metrics_textfile='', index_on_pull=False):
+        self.app_root = app_root
+        self.load_config = load_config
+        self.schedule = {}
+        self.current = []
+        self.versions = {}
+        self.make_updator = make_updator
+        self.jitter = jitter
+        self.workers = workers
+        self.metrics_log = metrics_log
+        self.metrics_textfile = metrics_textfile
+        self.index_on_pull = index_on_pull
+        self.running = False
+        data_dir = os.path.dirname(status_file(app_root))
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        self.status = {'pid': os.getpid(), 'state': 'running', 'started': time.time(), 'last_install': None,
+            'sources': {}}
+        self.reload(self.status['started'])
+
+    # 重新读取配置：加入新的源，移除不再刷新的源，间隔缩短时提前下一次运行
+    def reload(self, now):
+        config = self.load_config()
+        self.schedule = config['schedule']
+        self.current = list(config['current'])
+        self.versions = dict(config.get('versions') or {})
+        sources = self.status['sources']
+        for name in [n for n in sources if n not in self.schedule]:
+            del sources[name]
+        for name, interval in self.schedule.items():
+            if name not in sources:
+                # 首次运行在一个随机的小延迟内错开，避免多个源同时请求
+                sources[name] = {'last_pull': None, 'last_status': None, 'last_change': None,
+                    'next_run': now + random.uniform(0, interval * self.jitter), 'failures': 0, 'streak': 0,
+                    'last_error': ''}
+            else:
+                sources[name]['next_run'] = min(sources[name]['next_run'], now + interval * (1 + self.jitter))
+
+    # 下一次运行时间：间隔加上 ±jitter 比例的随机抖动；失败后按指数退避提前重试
+    def next_run(self, name, now):
+        interval = self.schedule[name]
+        streak = self.status['sources'][name]['streak']
+        if streak:
+            return now + mirrors.backoff_delay(streak, min(FAILURE_BACKOFF, interval), interval)
+        return now + interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def write_status(self):
+        path = status_file(self.app_root)
+        fd, tmp_file = tempfile.mkstemp(prefix='.daemon.', suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.status, f, indent=4, sort_keys=True)
+        replace_file(tmp_file, path)
+
+    # 拉取到期的源；正在使用的源内容变化时（依据 md5）重新安装 hosts，after_use 只在此时执行
+    # 安装的是历史版本的源不受拉取影响；最后为内容变化的源重建主机名索引
+    def run_due(self, now):
+        self.reload(now)
+        due = [name for name, s in self.status['sources'].items() if s['next_run'] <= now]
+        if not due:
+            return False
+        results = pull_many([self.make_updator(name) for name in due], workers=self.workers)
+        changed = []
+        for r in results:
+            s = self.status['sources'][r['name']]
+            s['last_pull'] = time.time()
+            s['last_status'] = r['status']
+            if r['status'] == 'failed':
+                s['failures'] += 1
+                s['streak'] += 1
+                s['last_error'] = r['error']
+            else:
+                s['streak'] = 0
+                s['last_error'] = ''
+            if r['status'] == 'updated':
+                s['last_change'] = s['last_pull']
+                changed.append(r['name'])
+            s['next_run'] = self.next_run(r['name'], s['last_pull'])
+        # 拉取期间可能执行了 use，安装前再读取一次配置
+        self.reload(time.time())
+        if [name for name in changed if name in self.current and self.versions.get(name) is None]:
+            updators = [self.make_updator(name) for name in self.current]
+            for u in updators:
+                u.version = self.versions.get(u.name)
+            try:
+                if updators[0].use(merge_with=updators[1:]):
+                    self.status['last_install'] = time.time()
+            except Exception as e:
+                logger.error('Failed installing hosts from source [%s]: %s' %(', '.join(self.current), e))
+        if self.index_on_pull:
+            index_sources(self.app_root, [self.make_updator(name) for name in changed])
+        return True
+
+    def stop(self, *args):
+        self.running = False
+
+    # 主循环，收到 SIGTERM 或 Ctrl-C 后完成当前一轮并退出
+    def run(self):
+        self.running = True
+        try:
+            signal.signal(signal.SIGTERM, self.stop)
+        except ValueError:
+            # 只有主线程可以设置信号处理函数
+            pass
+        logger.info('Daemon started, refreshing source(s): %s' %', '.join(
+            '%s every %ds' %(name, interval) for name, interval in sorted(self.schedule.items())))
+        self.write_status()
+        try:
+            while self.running:
+                now = time.time()
+                if self.run_due(now):
+                    self.write_status()
+                    metrics.flush(self.app_root, self.metrics_log, self.metrics_textfile)
+                wake = min([s['next_run'] for s in self.status['sources'].values()] or [now + 1])
+                # 分段睡眠，以便及时响应停止信号
+                time.sleep(max(0, min(wake - time.time(), 1)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.status['state'] = 'stopped'
+            self.write_status()
+            logger.info('Daemon stopped')
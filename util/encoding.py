@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import re
+import codecs
+
+# 按顺序尝试的编码：先根据 BOM 判断，否则先按 utf-8，失败再退回 gbk
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+DEFAULT_ENCODING = 'utf-8'
+FALLBACK_ENCODING = 'gbk'
+# 从第一个非 ASCII 字节开始，最多暂存这么多字节用于判断是 utf-8 还是 gbk
+SNIFF_SIZE = 64 * 1024
+NON_ASCII = re.compile(b'[\x80-\xff]')
+
+
+class Utf8Normalizer(object):
+    """Incrementally converts a byte stream of unknown encoding to UTF-8 with `\\n` line endings.
+
+    The encoding is detected on the fly: a BOM wins, otherwise the input is decoded as UTF-8.
+    From the first non-ASCII byte on, output is held back together with the raw bytes until
+    `SNIFF_SIZE` bytes have decoded as valid UTF-8 (the encoding is UTF-8), or an invalid byte
+    shows up (the held bytes are decoded again as GBK). Many GBK characters are also valid
+    UTF-8 byte pairs, so the first non-ASCII character alone cannot decide. Invalid bytes
+    found after the decision are replaced. `encoding` holds the result.\\n"""
+    def __init__(self):
+        self.encoding = None
+        self._head = b''
+        self._decoder = None
+        # 判断编码期间暂存的原始字节及其按 utf-8 解码的结果，None 表示还没有遇到非 ASCII 字节
+        self._sniffing = False
+        self._held = None
+        self._held_text = []
+        self._pending = ''
+
+    def _start(self, data):
+        self.encoding = DEFAULT_ENCODING
+        for bom, encoding in BOMS:
+            if data.startswith(bom):
+                self.encoding = encoding
+                data = data[len(bom):]
+                break
+        self._decoder = codecs.getincrementaldecoder(self.encoding.replace('-sig', ''))()
+        self._sniffing = self.encoding == DEFAULT_ENCODING
+        return data
+
+    def _decode(self, data, final):
+        if self._sniffing:
+            return self._sniff(data, final)
+        try:
+            return self._decoder.decode(data, final)
+        except UnicodeDecodeError as e:
+            if self.encoding != DEFAULT_ENCODING:
+                raise
+            # 已经确定为 utf-8 之后出现的非法字节，替换后继续解码
+            # e.object 包含解码器内部缓存的上一块末尾的不完整字节
+            good, bad = e.object[:e.start], e.object[e.start:]
+            self.encoding = 'utf-8 (with replaced bytes)'
+            self._decoder = codecs.getincrementaldecoder(DEFAULT_ENCODING)(errors='replace')
+            return good.decode(DEFAULT_ENCODING) + self._decoder.decode(bad, final)
+
+    # 编码未确定时的解码：ASCII 部分直接输出，从第一个非 ASCII 字节开始暂存，直到能够判断编码
+    def _sniff(self, data, final):
+        text = ''
+        if self._held is None:
+            match = NON_ASCII.search(data)
+            if match is None:
+                return data.decode('ascii')
+            text = data[:match.start()].decode('ascii')
+            data = data[match.start():]
+            self._held = b''
+        self._held += data
+        try:
+            self._held_text.append(self._decoder.decode(data, final))
+        except UnicodeDecodeError:
+            # 暂存的字节不是合法的 utf-8，全部改按 gbk 重新解码
+            held, self._held, self._held_text = self._held, None, []
+            self._sniffing = False
+            self.encoding = FALLBACK_ENCODING
+            self._decoder = codecs.getincrementaldecoder(FALLBACK_ENCODING)(errors='replace')
+            return text + self._decoder.decode(held, final)
+        if len(self._held) < SNIFF_SIZE and not final:
+            return text
+        text += ''.join(self._held_text)
+        self._sniffing = False
+        self._held, self._held_text = None, []
+        return text
+
+    # 统一换行符；以 \r 结尾时暂存，等待下一块判断是否为 \r\n
+    def _normalize(self, text, final):
+        text = self._pending + text
+        self._pending = ''
+        if text.endswith('\r') and not final:
+            text, self._pending = text[:-1], '\r'
+        return text.replace('\r\n', '\n').replace('\r', '\n').encode('utf8')
+
+    # 输入一块原始字节，返回可以写出的 UTF-8 字节
+    def feed(self, data):
+        if self._decoder is None:
+            # 至少积累 3 个字节才能识别 BOM
+            self._head += data
+            if len(self._head) < 3:
+                return b''
+            data, self._head = self._start(self._head), b''
+        return self._normalize(self._decode(data, False), False)
+
+    # 输入结束，返回剩余的 UTF-8 字节
+    def finish(self):
+        if self._decoder is None:
+            data = self._start(self._head)
+            return self._normalize(self._decode(data, True), True)
+        return self._normalize(self._decode(b'', True), True)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，使用 msvcrt 锁定文件的第一个字节
+    fcntl = None
+    import msvcrt
+
+# 等待锁时轮询的间隔（秒）
+POLL_INTERVAL = 0.05
+# 等待其他 hman 进程释放锁的默认最长时间（秒）
+LOCK_TIMEOUT = 300
+
+
+class LockTimeout(Exception):
+    """Raised when a file lock cannot be acquired in time.\n"""
+
+
+class FileLock(object):
+    """Exclusive advisory lock on a file, shared by threads and processes.
+    `timeout` is how long `acquire` waits, None waits forever and 0 does not wait.
+    The lock is reentrant within the thread that holds it.\n"""
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+        self._owner = None
+        self._depth = 0
+        self._thread_lock = threading.Lock()
+
+    def _try_lock(self, fd):
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EDEADLK):
+                return False
+            raise
+        return True
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if self._owner == threading.current_thread():
+            self._depth += 1
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        # 先在进程内排队，再与其他进程竞争文件锁
+        while not self._thread_lock.acquire(False):
+            if deadline is not None and time.time() >= deadline:
+                raise LockTimeout('Timed out waiting for lock %s' %self.path)
+            time.sleep(POLL_INTERVAL)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            while not self._try_lock(fd):
+                if deadline is not None and time.time() >= deadline:
+                    os.close(fd)
+                    raise LockTimeout('Timed out waiting for lock %s, is another hman running?' %self.path)
+                time.sleep(POLL_INTERVAL)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+        self._owner = threading.current_thread()
+        self._depth = 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth:
+            return
+        fd, self._fd, self._owner = self._fd, None, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
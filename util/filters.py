@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from util import parser
+
+# 规则写法：/.../ 为正则表达式，*.example.com 匹配 example.com 的所有子域名，其他为完整的主机名
+REGEX_DELIMITER = '/'
+SUFFIX_PREFIX = '*.'
+# 未匹配任何 allow 规则而被丢弃时，统计在这个名称下
+NOT_ALLOWED = '(not allowed)'
+
+
+class RuleSet(object):
+    """Compiled hostname rules: exact names in a set, suffix rules in a set of suffixes
+    looked up once per label, regexes combined into a single alternation.
+    Matching a hostname is O(number of labels) plus one regex search.\n"""
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.exact = {}
+        self.suffixes = {}
+        patterns = []
+        self.regex_rules = []
+        for rule in self.rules:
+            if len(rule) > 2 and rule.startswith(REGEX_DELIMITER) and rule.endswith(REGEX_DELIMITER):
+                try:
+                    re.compile(rule[1:-1])
+                except re.error as e:
+                    raise ValueError('Invalid filter rule %s: %s' %(rule, e))
+                patterns.append('(?:%s)' %rule[1:-1])
+                self.regex_rules.append(rule)
+            elif rule.startswith(SUFFIX_PREFIX) and len(rule) > len(SUFFIX_PREFIX):
+                self.suffixes.setdefault(rule[len(SUFFIX_PREFIX):].lower(), rule)
+            else:
+                self.exact.setdefault(rule.lower(), rule)
+        # 多个正则合并为一个，匹配成功后再逐个确定是哪条规则
+        self.regex = re.compile('|'.join(patterns)) if patterns else None
+        self.regexes = [(rule, re.compile(rule[1:-1])) for rule in self.regex_rules]
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    __nonzero__ = __bool__
+
+    # 返回匹配 hostname 的第一条规则，没有匹配返回 None
+    def match(self, hostname):
+        rule = self.exact.get(hostname)
+        if rule is not None:
+            return rule
+        if self.suffixes:
+            dot = hostname.find('.')
+            while dot >= 0:
+                rule = self.suffixes.get(hostname[dot + 1:])
+                if rule is not None:
+                    return rule
+                dot = hostname.find('.', dot + 1)
+        if self.regex is not None and self.regex.search(hostname):
+            for rule, regex in self.regexes:
+                if regex.search(hostname):
+                    return rule
+        return None
+
+
+class HostsFilter(object):
+    """Filter stage applied to source lines before they are installed.
+    A hostname is dropped if it matches a `deny` rule, or if `allow` rules are given
+    and it matches none of them. `dropped` counts dropped hostnames per rule.\n"""
+    def __init__(self, allow=(), deny=()):
+        self.allow = RuleSet(allow)
+        self.deny = RuleSet(deny)
+        self.dropped = {}
+
+    def __bool__(self):
+        return bool(self.allow or self.deny)
+
+    __nonzero__ = __bool__
+
+    # 返回使 hostname 被丢弃的规则，保留时返回 None
+    def drop_rule(self, hostname):
+        rule = self.deny.match(hostname)
+        if rule is not None:
+            return rule
+        if self.allow and self.allow.match(hostname) is None:
+            return NOT_ALLOWED
+        return None
+
+    # 过滤文本行：丢弃被过滤的主机名，一行中的主机名全部被丢弃时删除该行，其他行原样输出
+    def filter_lines(self, lines):
+        dropped = self.dropped
+        for line in lines:
+            parsed = parser.parse_line(line)
+            if parsed is None:
+                yield line
+                continue
+            ip, hostnames, comment = parsed
+            keep = []
+            for hostname in hostnames:
+                rule = self.drop_rule(hostname)
+                if rule is None:
+                    keep.append(hostname)
+                else:
+                    dropped[rule] = dropped.get(rule, 0) + 1
+            if len(keep) == len(hostnames):
+                yield line
+            elif keep:
+                yield parser.HostsEntry(ip, keep, comment).to_line() + '\n'
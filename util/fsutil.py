@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import hashlib
+
+CHUNK_SIZE = 64 * 1024
+NEW_FILE_MODE = 0o644
+
+
+# 以原子方式用 src 替换 dst
+# src 通常由 mkstemp 创建，只有属主可读；替换前改为 dst 原有的权限，dst 不存在时为 0644，
+# 使普通用户执行只读命令时仍能读取 root 写入的文件
+def replace_file(src, dst):
+    try:
+        mode = stat.S_IMODE(os.stat(dst).st_mode)
+    except OSError:
+        mode = NEW_FILE_MODE
+    os.chmod(src, mode)
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2 没有 os.replace
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import time
+import json
+import gzip
+import shutil
+import tempfile
+
+from util import compression
+from util.fsutil import replace_file
+
+HISTORY_DIR = 'history'
+MANIFEST_NAME = 'manifest.json'
+# 安装历史版本时解压出的完整内容放在这里，只保留最近一次用到的版本
+CHECKOUT_DIR = 'checkout'
+FULL_SUFFIX = '.gz'
+DELTA_SUFFIX = '.delta.gz'
+COMPRESS_LEVEL = 6
+CHUNK_SIZE = 64 * 1024
+# 计算增量时新旧内容都要按行读入内存，超过这个大小的版本直接保留完整的压缩快照，使内存占用有上限
+DELTA_MAX_SIZE = 8 * 1024 * 1024
+
+# 每个源默认保留的历史版本数
+HISTORY_KEEP = 30
+# 按 md5 前缀查找版本时前缀的最短长度，避免与版本号混淆
+MIN_DIGEST_PREFIX = 4
+
+
+# 计算由 base 得到 target 的行级增量，返回 [('c', start, count) | ('i', lines)]
+# 连续出现在 base 中的行记为复制区间，其余的行原样插入；只遍历一次，不追求最短的增量，
+# 适合 hosts 这种大部分行不变、变化分散在各处的内容
+def make_delta(base, target):
+    index = {}
+    for i, line in enumerate(base):
+        index.setdefault(line, i)
+    ops = []
+    start = count = 0
+    inserted = []
+    for line in target:
+        pos = start + count
+        if count and pos < len(base) and base[pos] == line:
+            count += 1
+            continue
+        i = index.get(line)
+        if i is None:
+            if count:
+                ops.append(('c', start, count))
+                count = 0
+            inserted.append(line)
+            continue
+        if count:
+            ops.append(('c', start, count))
+        if inserted:
+            ops.append(('i', inserted))
+            inserted = []
+        start, count = i, 1
+    if count:
+        ops.append(('c', start, count))
+    if inserted:
+        ops.append(('i', inserted))
+    return ops
+
+
+# 增量的存储格式：`c <start> <count>` 复制 base 中的行，`i <count> <bytes>` 后接插入的原始内容
+def write_delta(f, ops):
+    for op in ops:
+        if op[0] == 'c':
+            f.write(('c %d %d\n' %(op[1], op[2])).encode('ascii'))
+        else:
+            data = b''.join(op[1])
+            f.write(('i %d %d\n' %(len(op[1]), len(data))).encode('ascii'))
+            f.write(data)
+
+
+def apply_delta(base, f):
+    target = []
+    for header in iter(f.readline, b''):
+        fields = header.split()
+        if fields[0] == b'c':
+            start, count = int(fields[1]), int(fields[2])
+            target.extend(base[start:start + count])
+        elif fields[0] == b'i':
+            target.extend(f.read(int(fields[2])).splitlines(True))
+        else:
+            raise ValueError('Corrupted history delta: %r' %header)
+    return target
+
+
+class SourceHistory(object):
+    """Versions of a source kept in `data/<name>/history/`.
+
+    The newest content is stored as a full gzip snapshot `<md5>.gz`; every older content
+    as `<md5>.delta.gz`, a compressed reverse line delta against the next newer content.
+    A pull therefore grows the history by roughly the compressed change, not by a copy.
+    Contents larger than `DELTA_MAX_SIZE` keep their full snapshot instead, so the memory
+    used while pulling stays bounded.
+    `manifest.json` holds `versions` ({version, time, digest, size, entries}, oldest first)
+    and `objects`, mapping each stored md5 to the md5 its delta is based on (None if full).\n"""
+    def __init__(self, working_dir, keep=HISTORY_KEEP):
+        self.root = os.path.join(working_dir, HISTORY_DIR)
+        self.manifest_file = os.path.join(self.root, MANIFEST_NAME)
+        self.keep = keep
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'versions': [], 'objects': {}}
+
+    def _write_manifest(self, manifest):
+        fd, tmp_file = tempfile.mkstemp(prefix='.manifest.', suffix='.tmp', dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        replace_file(tmp_file, self.manifest_file)
+
+    def versions(self):
+        return self.read_manifest()['versions']
+
+    def object_path(self, digest, base=None):
+        return os.path.join(self.root, digest + (FULL_SUFFIX if base is None else DELTA_SUFFIX))
+
+    # 写入一个对象：base 为 None 时 data 为内容的源文件（可以是压缩格式），流式复制；否则为增量
+    # 返回原始内容的字节数
+    def _write_object(self, digest, base, data):
+        path = self.object_path(digest, base)
+        fd, tmp_file = tempfile.mkstemp(prefix='.object.', suffix='.tmp', dir=self.root)
+        os.close(fd)
+        try:
+            with gzip.open(tmp_file, 'wb', compresslevel=COMPRESS_LEVEL) as f:
+                if base is None:
+                    with compression.open_read(data) as src:
+                        shutil.copyfileobj(src, f, CHUNK_SIZE)
+                else:
+                    write_delta(f, data)
+                size = f.tell()
+            replace_file(tmp_file, path)
+        except BaseException:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return size
+
+    # 读取某个内容的全部行：从完整快照出发，沿增量链依次还原
+    def read_lines(self, digest, manifest=None):
+        objects = (manifest or self.read_manifest())['objects']
+        chain = [digest]
+        while objects[chain[-1]] is not None:
+            chain.append(objects[chain[-1]])
+        with gzip.open(self.object_path(chain[-1]), 'rb') as f:
+            lines = f.read().splitlines(True)
+        for i in range(len(chain) - 2, -1, -1):
+            with gzip.open(self.object_path(chain[i], chain[i + 1]), 'rb') as f:
+                lines = apply_delta(lines, f)
+        return lines
+
+    # 将 path（本地缓存，可以是压缩格式）保存为最新版本，digest 为其 md5，entries 为条目数
+    # 原来的最新版本改存为相对新内容的增量；与最新版本相同时不做任何事，返回 None
+    def add(self, path, digest, entries=None, now=None):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        manifest = self.read_manifest()
+        versions, objects = manifest['versions'], manifest['objects']
+        newest = versions[-1]['digest'] if versions else None
+        if newest == digest:
+            return None
+        stale = []
+        size = self._write_object(digest, None, path)
+        if objects.get(digest) is not None:
+            # 曾经出现过的内容再次成为最新版本，改为完整存储
+            stale.append(self.object_path(digest, objects[digest]))
+        objects[digest] = None
+        # 原来的最新版本是完整快照，新旧内容都不太大时才改存为增量
+        if newest is not None and max(size, versions[-1]['size']) <= DELTA_MAX_SIZE:
+            with compression.open_read(path) as f:
+                lines = f.read().splitlines(True)
+            self._write_object(newest, digest, make_delta(lines, self.read_lines(newest, manifest)))
+            objects[newest] = digest
+            stale.append(self.object_path(newest))
+        entry = {'version': versions[-1]['version'] + 1 if versions else 1,
+            'time': time.time() if now is None else now, 'digest': digest,
+            'size': size, 'entries': entries}
+        versions.append(entry)
+        stale.extend(self.prune(manifest))
+        # 先写入清单，再删除不再使用的文件，中断时最多留下多余的文件
+        self._write_manifest(manifest)
+        for stale_file in stale:
+            if os.path.isfile(stale_file):
+                os.remove(stale_file)
+        return entry
+
+    # 只保留最新的 keep 个版本，以及还原它们所需的对象；返回需要删除的文件
+    def prune(self, manifest):
+        versions, objects = manifest['versions'], manifest['objects']
+        del versions[:max(0, len(versions) - self.keep)]
+        needed = set()
+        for entry in versions:
+            digest = entry['digest']
+            while digest is not None and digest not in needed:
+                needed.add(digest)
+                digest = objects[digest]
+        stale = []
+        for digest in [d for d in objects if d not in needed]:
+            stale.append(self.object_path(digest, objects.pop(digest)))
+        return stale
+
+    # 按版本号或至少 MIN_DIGEST_PREFIX 位的 md5 前缀查找版本，找不到或有歧义时抛出异常
+    def find(self, version_id):
+        versions = self.versions()
+        version_id = str(version_id)
+        matched = [e for e in versions if str(e['version']) == version_id]
+        if not matched and len(version_id) >= MIN_DIGEST_PREFIX:
+            matched = list(dict((e['digest'], e) for e in versions if e['digest'].startswith(version_id)).values())
+        if not matched:
+            raise Exception('Version "%s" not found in history' %version_id)
+        if len(matched) > 1:
+            raise Exception('Version "%s" is ambiguous, use a longer digest prefix' %version_id)
+        return matched[0]
+
+    # 以文本行方式逐行读取某个版本的内容，不写入任何文件，没有写权限时也可以使用
+    def iter_lines(self, version_id):
+        digest = self.find(version_id)['digest']
+        manifest = self.read_manifest()
+        if manifest['objects'][digest] is None:
+            with gzip.open(self.object_path(digest), 'rb') as f:
+                for line in io.TextIOWrapper(f, encoding='utf8', newline=''):
+                    yield line
+        else:
+            for line in self.read_lines(digest, manifest):
+                yield line.decode('utf8')
+
+    # 解压出某个版本的完整内容用于安装，返回文件路径
+    def checkout(self, version_id):
+        digest = self.find(version_id)['digest']
+        checkout_dir = os.path.join(self.root, CHECKOUT_DIR)
+        if not os.path.isdir(checkout_dir):
+            os.makedirs(checkout_dir)
+        path = os.path.join(checkout_dir, digest + '.txt')
+        if not os.path.isfile(path):
+            objects = self.read_manifest()['objects']
+            fd, tmp_file = tempfile.mkstemp(prefix='.checkout.', suffix='.tmp', dir=checkout_dir)
+            with os.fdopen(fd, 'wb') as f:
+                if objects[digest] is None:
+                    with gzip.open(self.object_path(digest), 'rb') as src:
+                        shutil.copyfileobj(src, f, CHUNK_SIZE)
+                else:
+                    # 存为增量的版本不超过 DELTA_MAX_SIZE
+                    f.writelines(self.read_lines(digest))
+            replace_file(tmp_file, path)
+        for name in os.listdir(checkout_dir):
+            if name != digest + '.txt' and name.endswith('.txt'):
+                os.remove(os.path.join(checkout_dir, name))
+        return path
+
+    # 各版本占用的磁盘空间之和
+    def stored_size(self):
+        objects = self.read_manifest()['objects']
+        return sum(os.path.getsize(self.object_path(d, b)) for d, b in objects.items()
+            if os.path.isfile(self.object_path(d, b)))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import subprocess
+
+try:
+    # For Python 3
+    from shutil import which
+except ImportError:
+    # Fall back to Python 2
+    from distutils.spawn import find_executable as which
+
+logger = logging.getLogger('HostsUpdator')
+
+
+# 当前是否有名为 name 的进程在运行；有 /proc 时直接读取，否则使用 pgrep
+def process_running(name):
+    if not os.path.isdir('/proc'):
+        if not which('pgrep'):
+            return False
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['pgrep', '-x', name], stdout=devnull) == 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'comm'), 'r') as f:
+                if f.read().strip() == name:
+                    return True
+        except (IOError, OSError):
+            continue
+    return False
+
+
+def resolved_command():
+    if which('resolvectl'):
+        return ['resolvectl', 'flush-caches']
+    return ['systemd-resolve', '--flush-caches']
+
+
+# 内置的钩子：名称 -> (适用的系统, 检测函数, 生成命令的函数)
+# 检测函数判断对应的缓存是否存在，自动模式下只执行检测通过的钩子
+HOOKS = {
+    'systemd-resolved': (('Linux',),
+        lambda: os.path.isdir('/run/systemd/resolve') and bool(which('resolvectl') or which('systemd-resolve')),
+        lambda: [resolved_command()]),
+    'nscd': (('Linux',),
+        lambda: bool(which('nscd')) and (os.path.exists('/run/nscd/socket') or os.path.exists('/var/run/nscd/socket')),
+        lambda: [['nscd', '-i', 'hosts']]),
+    # dnsmasq 收到 SIGHUP 后重新读取 hosts 并清空缓存
+    'dnsmasq': (('Linux', 'Darwin'),
+        lambda: process_running('dnsmasq'),
+        lambda: [['pkill', '-HUP', '-x', 'dnsmasq']]),
+    'windows-dns': (('Windows',), lambda: True, lambda: [['ipconfig', '/flushdns']]),
+    'macos-dns': (('Darwin',), lambda: True,
+        lambda: [['dscacheutil', '-flushcache'], ['killall', '-HUP', 'mDNSResponder']]),
+    # 旧版本的行为：重启网络，会中断现有连接，只在显式配置时使用
+    'restart-networking': (('Linux', 'Darwin'), lambda: False,
+        lambda: [['/etc/init.d/networking', 'restart']] if os.path.exists('/etc/init.d/networking')
+            else [['ifconfig', 'en0', 'down'], ['ifconfig', 'en0', 'up']]),
+}
+
+
+# 自动检测当前系统上存在的 DNS 缓存，返回需要执行的内置钩子名称
+def detect_hooks(system):
+    names = []
+    for name, (systems, detect, _) in sorted(HOOKS.items()):
+        if system not in systems:
+            continue
+        try:
+            if detect():
+                names.append(name)
+        except (IOError, OSError):
+            continue
+    return names
+
+
+# 执行 hosts 安装后的钩子，hooks 为 'auto'（自动检测）或列表
+# 列表中的项为内置钩子名称或自定义的 shell 命令，空列表表示什么也不做
+# 单个钩子失败只记录警告；返回 [{'hook', 'ok', 'elapsed'}]
+def run_hooks(hooks, system):
+    if hooks == 'auto':
+        hooks = detect_hooks(system)
+    results = []
+    for hook in hooks:
+        start = time.time()
+        try:
+            if hook in HOOKS:
+                commands = HOOKS[hook][2]()
+                ok = all([subprocess.call(cmd) == 0 for cmd in commands])
+            else:
+                ok = subprocess.call(hook, shell=True) == 0
+        except (IOError, OSError) as e:
+            logger.warning('Failed running hook [%s]: %s' %(hook, e))
+            ok = False
+        elapsed = time.time() - start
+        if ok:
+            logger.info('Finished hook [%s] in %.0fms' %(hook, elapsed * 1000))
+        else:
+            logger.warning('Hook [%s] failed after %.0fms' %(hook, elapsed * 1000))
+        results.append({'hook': hook, 'ok': ok, 'elapsed': elapsed})
+    if not hooks:
+        logger.info('No DNS cache to flush')
+    return results
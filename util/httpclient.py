@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import threading
+
+try:
+    # For Python 3
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit, urljoin
+    from urllib.request import urlopen, Request, getproxies
+    from urllib.error import HTTPError
+except ImportError:
+    # Fall back to Python 2
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit, urljoin
+    from urllib2 import urlopen, Request, HTTPError
+    from urllib import getproxies
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# 可能是临时故障、值得重试的状态码
+RETRYABLE_CODES = (408, 425, 429, 500, 502, 503, 504)
+# 每个源站最多保留的空闲连接数
+MAX_IDLE_PER_ORIGIN = 4
+USER_AGENT = 'hosts-manager'
+
+
+class HttpError(Exception):
+    """Non-2xx/304 HTTP response.\n"""
+    def __init__(self, code, reason, url):
+        Exception.__init__(self, 'HTTP Error %d: %s (%s)' %(code, reason, url))
+        self.code = code
+        self.reason = reason
+        self.url = url
+
+
+class _TimedConnectionMixin(object):
+    """Records DNS/connect/TLS time of `connect()` in `self.timing`,
+    and switches the socket to the read timeout once connected.\n"""
+    read_timeout = None
+
+    def _timed_connect(self):
+        self.timing = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+        start = time.time()
+        infos = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        self.timing['dns'] = time.time() - start
+        error = None
+        start = time.time()
+        for family, socktype, proto, _, address in infos:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except socket.error as e:
+                sock.close()
+                error = e
+                continue
+            self.sock = sock
+            break
+        else:
+            raise error or socket.error('getaddrinfo returns an empty list')
+        self.timing['connect'] = time.time() - start
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    def connect(self):
+        self._timed_connect()
+        self.sock.settimeout(self.read_timeout)
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        self._timed_connect()
+        start = time.time()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+        self.timing['tls'] = time.time() - start
+        self.sock.settimeout(self.read_timeout)
+
+
+class Response(object):
+    """Body stream of a pooled HTTP response.
+    Reading the body to the end and closing returns the connection to the pool.\n"""
+    def __init__(self, client, origin, conn, response, url, timing):
+        self.client = client
+        self.origin = origin
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.url = url
+        self.timing = timing
+        self._body_start = time.time()
+
+    def info(self):
+        return self.response.msg
+
+    def read(self, size=-1):
+        data = self.response.read(size) if size >= 0 else self.response.read()
+        if not data:
+            self.timing['transfer'] = time.time() - self._body_start
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.client._release(self.origin, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+
+class _UrllibResponse(object):
+    """Adapts a `urlopen` response (used when a proxy is configured) to the `Response` interface.\n"""
+    def __init__(self, response, status, url, timing):
+        self.response = response
+        self.status = status
+        self.url = url
+        self.timing = timing
+        self._body_start = time.time()
+
+    def info(self):
+        return self.response.info()
+
+    def read(self, size=-1):
+        data = self.response.read(size) if self.response is not None else b''
+        if not data:
+            self.timing['transfer'] = time.time() - self._body_start
+        return data
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
+class HttpClient(object):
+    """Minimal thread-safe HTTP client that keeps keep-alive connections per origin
+    (scheme, host, port), follows redirects and times every request.\n"""
+    def __init__(self, max_idle_per_origin=MAX_IDLE_PER_ORIGIN):
+        self.max_idle_per_origin = max_idle_per_origin
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _origin(url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme: %s' %url)
+        port = parts.port or (443 if scheme == 'https' else 80)
+        return scheme, parts.hostname, port
+
+    def _acquire(self, origin, connect_timeout, read_timeout):
+        with self._lock:
+            idle = self._idle.get(origin)
+            if idle:
+                conn = idle.pop()
+                conn.sock.settimeout(read_timeout)
+                return conn, True
+        scheme, host, port = origin
+        cls = TimedHTTPSConnection if scheme == 'https' else TimedHTTPConnection
+        conn = cls(host, port, timeout=connect_timeout)
+        conn.read_timeout = read_timeout
+        return conn, False
+
+    def _release(self, origin, conn):
+        with self._lock:
+            idle = self._idle.setdefault(origin, [])
+            if len(idle) < self.max_idle_per_origin:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, url, headers, connect_timeout, read_timeout):
+        origin = self._origin(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self._acquire(origin, connect_timeout, read_timeout)
+            timing = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0, 'ttfb': 0.0, 'transfer': 0.0, 'reused': reused}
+            try:
+                start = time.time()
+                conn.request('GET', path, headers=headers)
+                if not reused:
+                    timing.update(conn.timing)
+                    start += conn.timing['dns'] + conn.timing['connect'] + conn.timing['tls']
+                response = conn.getresponse()
+                timing['ttfb'] = time.time() - start
+            except (socket.error, HTTPException):
+                conn.close()
+                # 空闲连接可能已被服务器关闭，换一个新连接重试
+                if reused:
+                    continue
+                raise
+            return Response(self, origin, conn, response, url, timing)
+
+    # 发送 GET 请求，跟随重定向；返回 2xx 或 304 的响应，其他状态码抛出 HttpError
+    def get(self, url, headers=None, connect_timeout=None, read_timeout=None):
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        scheme = urlsplit(url).scheme.lower()
+        if getproxies().get(scheme):
+            return self._get_via_urllib(url, headers, connect_timeout)
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._send(url, headers, connect_timeout, read_timeout)
+            if response.status in REDIRECT_CODES:
+                location = response.info().get('Location')
+                response.read()
+                response.close()
+                if not location:
+                    raise HttpError(response.status, 'redirect without Location', url)
+                url = urljoin(url, location)
+                continue
+            if response.status == 304 or 200 <= response.status < 300:
+                return response
+            reason = response.response.reason
+            response.read()
+            response.close()
+            raise HttpError(response.status, reason, url)
+        raise HttpError(response.status, 'too many redirects', url)
+
+    # 配置了代理时退回到 urllib，不复用连接，只记录首字节时间
+    @staticmethod
+    def _get_via_urllib(url, headers, timeout):
+        timing = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0, 'ttfb': 0.0, 'transfer': 0.0, 'reused': False}
+        start = time.time()
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=timeout)
+        except HTTPError as e:
+            if e.code != 304:
+                raise HttpError(e.code, e.reason, url)
+            timing['ttfb'] = time.time() - start
+            return _UrllibResponse(None, 304, url, timing)
+        timing['ttfb'] = time.time() - start
+        return _UrllibResponse(response, response.getcode(), response.geturl(), timing)
+
+
+_shared_client = None
+_shared_lock = threading.Lock()
+
+
+# 进程内共享的客户端，同一源站的多个源可以复用连接
+def shared_client():
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = HttpClient()
+        return _shared_client
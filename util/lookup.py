@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import os
+import uuid
+import sqlite3
+import contextlib
+
+from util import parser
+from util.filelock import FileLock, LOCK_TIMEOUT
+
+INDEX_NAME = '.hosts-index.sqlite'
+# 写入索引时持有的锁，多个进程依次写入，不依赖 SQLite 的忙等待
+LOCK_NAME = '.hosts-index.lock'
+# 通配符，模式中不含这些字符时按子串查找
+GLOB_CHARS = '*?['
+# 每批写入的行数
+BATCH_SIZE = 10000
+
+
+# 逐字符反转的主机名，如 a.example.com -> moc.elpmaxe.a，使后缀查询变为前缀范围查询
+def reverse_name(hostname):
+    return hostname[::-1]
+
+
+# 以 prefix 开头的字符串范围 [prefix, upper)
+def prefix_range(prefix):
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class LookupIndex(object):
+    """Hostname index of all cached sources, kept in SQLite at `data/.hosts-index.sqlite`.
+    Maps each hostname to (source, ip, line); a source is reindexed only when its md5 changes.
+
+    Each source has its own table: a rebuild fills a new table without indexes, builds the
+    indexes in bulk and then swaps it in, dropping the old table. Queries go through the
+    temporary view `hosts`, a UNION ALL of the source tables.
+    Writes run in explicit transactions (the connection is in autocommit mode), so a
+    rebuild that is interrupted leaves no half-filled table behind.\n"""
+    def __init__(self, app_root, lock_timeout=LOCK_TIMEOUT):
+        data_dir = os.path.join(app_root, 'data')
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        self.path = os.path.join(data_dir, INDEX_NAME)
+        self.lock = FileLock(os.path.join(data_dir, LOCK_NAME), timeout=lock_timeout)
+        # 自行管理事务，避免 sqlite3 模块在 CREATE TABLE 等语句前隐式提交
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self._create()
+
+    # 持有写锁的事务，出错时回滚
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                yield
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def _create(self):
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(sources)')]
+        if 'tbl' in columns:
+            return
+        with self._transaction():
+            if columns and 'tbl' not in columns:
+                # 旧版本的索引把所有源放在一张表中，索引只是缓存，直接丢弃后重建
+                self.conn.execute('DROP TABLE IF EXISTS hosts')
+                self.conn.execute('DROP TABLE sources')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS sources '
+                '(name TEXT PRIMARY KEY, md5 TEXT NOT NULL, tbl TEXT NOT NULL)')
+
+    def close(self):
+        self.conn.close()
+
+    # 已索引的源及其内容的 md5
+    def indexed(self):
+        return dict(self.conn.execute('SELECT name, md5 FROM sources'))
+
+    # 重新创建查询用的临时视图 hosts (hostname, reversed, source, ip, line)
+    def _create_view(self):
+        quote = lambda text: "'%s'" %text.replace("'", "''")
+        selects = ['SELECT hostname, reversed, %s AS source, ip, line FROM %s' %(quote(name), tbl)
+            for name, tbl in self.conn.execute('SELECT name, tbl FROM sources ORDER BY name')]
+        if not selects:
+            selects = ["SELECT '' AS hostname, '' AS reversed, '' AS source, '' AS ip, 0 AS line WHERE 0"]
+        self.conn.execute('DROP VIEW IF EXISTS temp.hosts')
+        self.conn.execute('CREATE TEMP VIEW hosts AS %s' %' UNION ALL '.join(selects))
+
+    @staticmethod
+    def _rows(path):
+        for lineno, line in enumerate(parser.iter_lines(path), 1):
+            parsed = parser.parse_line(line)
+            if parsed is None:
+                continue
+            ip, hostnames, _ = parsed
+            for hostname in hostnames:
+                yield hostname, reverse_name(hostname), ip, lineno
+
+    # 用缓存文件 path 的内容重建一个源的索引，建表、写入和替换在同一个事务中完成，
+    # 查询方不会看到一半的结果，中断时新表随事务一起回滚
+    # 先写入没有索引的新表，再一次性建立索引，比逐行维护索引快得多
+    def update_source(self, name, md5, path):
+        tbl = 'hosts_' + uuid.uuid4().hex
+        with self._transaction():
+            self.conn.execute('CREATE TABLE %s (hostname TEXT NOT NULL, reversed TEXT NOT NULL, '
+                'ip TEXT NOT NULL, line INTEGER NOT NULL)' %tbl)
+            rows = self._rows(path)
+            while True:
+                batch = [row for _, row in zip(range(BATCH_SIZE), rows)]
+                if not batch:
+                    break
+                self.conn.executemany('INSERT INTO %s VALUES (?, ?, ?, ?)' %tbl, batch)
+            self.conn.execute('CREATE INDEX %s_hostname ON %s (hostname)' %(tbl, tbl))
+            self.conn.execute('CREATE INDEX %s_reversed ON %s (reversed)' %(tbl, tbl))
+            self._drop_table(name)
+            self.conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (name, md5, tbl))
+
+    def _drop_table(self, name):
+        row = self.conn.execute('SELECT tbl FROM sources WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            self.conn.execute('DROP TABLE IF EXISTS %s' %row[0])
+
+    def remove_source(self, name):
+        with self._transaction():
+            self._drop_table(name)
+            self.conn.execute('DELETE FROM sources WHERE name = ?', (name,))
+
+    # 只重建 md5 变化的源，返回重建的源名称列表
+    def refresh(self, updators):
+        indexed = self.indexed()
+        rebuilt = []
+        for u in updators:
+            if not u.has_cache():
+                continue
+            md5 = u.source_digest()
+            if indexed.get(u.name) != md5:
+                self.update_source(u.name, md5, u.cached_hosts())
+                rebuilt.append(u.name)
+        return rebuilt
+
+    # 使索引与各个源的本地缓存一致：重建 md5 变化的源，删除已不存在或没有缓存的源，
+    # 以及旧版本中断重建时留下的、sources 中没有记录的表；返回重建的源名称列表
+    def sync(self, updators):
+        rebuilt = self.refresh(updators)
+        names = set(u.name for u in updators if u.has_cache())
+        for name in self.indexed():
+            if name not in names:
+                self.remove_source(name)
+        self.drop_orphans()
+        return rebuilt
+
+    def drop_orphans(self):
+        sql = ("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'hosts\\_%' ESCAPE '\\' "
+            'AND name NOT IN (SELECT tbl FROM sources)')
+        orphans = [row[0] for row in self.conn.execute(sql)]
+        if orphans:
+            with self._transaction():
+                for tbl in orphans:
+                    self.conn.execute('DROP TABLE IF EXISTS %s' %tbl)
+
+    # 精确查找主机名，返回 [(source, ip, line)]
+    def which(self, hostname):
+        self._create_view()
+        return self.conn.execute('SELECT source, ip, line FROM hosts WHERE hostname = ? ORDER BY source, line',
+            (hostname.lower(),)).fetchall()
+
+    # 按模式查找，返回 [(hostname, source, ip, line)]，最多 limit 个主机名
+    # 模式不含通配符时按子串匹配；`*.example.com` 形式的后缀和 `ads.*` 形式的前缀使用索引范围查询，
+    # 其他通配符模式按 GLOB 匹配索引中的主机名，都不需要读取 hosts 文件
+    def search(self, pattern, limit=None):
+        self._create_view()
+        pattern = pattern.lower()
+        if not any(c in pattern for c in GLOB_CHARS):
+            pattern = '*' + pattern + '*'
+        head, tail = pattern[:1], pattern[1:]
+        if head == '*' and tail and not any(c in tail for c in GLOB_CHARS):
+            column, bounds = 'reversed', prefix_range(reverse_name(tail))
+        elif pattern[-1:] == '*' and pattern[:-1] and not any(c in pattern[:-1] for c in GLOB_CHARS):
+            column, bounds = 'hostname', prefix_range(pattern[:-1])
+        else:
+            column, bounds = 'hostname', None
+        if bounds is not None:
+            where, args = '{0} >= ? AND {0} < ?'.format(column), bounds
+        else:
+            where, args = 'hostname GLOB ?', (pattern,)
+        # 先选出不超过 limit 个主机名，再取出它们在各个源中的映射
+        names = 'SELECT DISTINCT hostname FROM hosts WHERE %s ORDER BY %s' %(where, column)
+        if limit is not None:
+            names += ' LIMIT %d' %limit
+        sql = ('SELECT hostname, source, ip, line FROM hosts WHERE hostname IN (%s) '
+            'ORDER BY %s, source, line' %(names, column))
+        return self.conn.execute(sql, args).fetchall()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from util import parser
+
+SOURCE_HEADER = '# ---------- source: {name} ---------- #\n'
+
+
+# 流式合并多个源的 hosts，按 sources 的顺序，靠前的源优先
+# sources 为 [(name, lines)]，lines 为可迭代的文本行；结果逐行写入文本文件对象 out
+# 同一主机名只保留第一次出现的映射：ip 相同的计为 duplicates，ip 不同的计为 conflicts
+# IPv4 与 IPv6 映射分开去重，一个主机名可以同时有两种地址
+# 返回每个源的统计信息 [{'name', 'entries', 'duplicates', 'conflicts'}]
+def merge(sources, out):
+    seen4 = {}
+    seen6 = {}
+    stats = []
+    for name, lines in sources:
+        stat = {'name': name, 'entries': 0, 'duplicates': 0, 'conflicts': 0}
+        out.write(SOURCE_HEADER.format(name=name))
+        for line in lines:
+            if not line.endswith('\n'):
+                line += '\n'
+            parsed = parser.parse_line(line)
+            if parsed is None:
+                out.write(line)
+                continue
+            ip, hostnames, comment = parsed
+            seen = seen6 if ':' in ip else seen4
+            keep = []
+            for hostname in hostnames:
+                mapped = seen.get(hostname)
+                if mapped is None:
+                    seen[hostname] = ip
+                    keep.append(hostname)
+                elif mapped == ip:
+                    stat['duplicates'] += 1
+                else:
+                    stat['conflicts'] += 1
+            stat['entries'] += len(keep)
+            if len(keep) == len(hostnames):
+                out.write(line)
+            elif keep:
+                out.write(parser.HostsEntry(ip, keep, comment).to_line() + '\n')
+        stats.append(stat)
+    return stats
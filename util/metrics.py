@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import contextlib
+
+from util.filelock import FileLock
+from util.fsutil import replace_file
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 没有 tracemalloc，--profile 只统计耗时
+    tracemalloc = None
+
+# 作为 Prometheus 标签导出的字段，其余字段只写入 JSON 日志
+LABELS = ('source', 'status', 'mode', 'command')
+# 汇总的指标保存在这里，每次导出时累加，使多次一次性执行的计数可以连续增长
+STATE_NAME = '.metrics.json'
+LOCK_NAME = '.metrics.lock'
+METRIC_PREFIX = 'hman_'
+# 未导出时内存中最多保留的事件数，超过后丢弃最早的事件
+MAX_EVENTS = 10000
+
+# --profile 输出的函数个数、内存分配位置个数，以及 tracemalloc 记录的栈深度
+PROFILE_LIMIT = 30
+PROFILE_MEMORY_LIMIT = 15
+PROFILE_FRAMES = 10
+
+
+class Metrics(object):
+    """In-memory buffer of timing and counter events of the current process.
+
+    Each event is a dict with `event`, `time`, `duration` and any other fields,
+    e.g. `source`, `status`, `bytes`. Events are recorded from any thread and
+    exported by `flush()` as JSON lines and a Prometheus textfile.\n"""
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    # 记录一个事件，值为 None 的字段被忽略
+    def record(self, event, duration=None, **fields):
+        fields = dict((k, v) for k, v in fields.items() if v is not None)
+        fields.update({'event': event, 'time': time.time()})
+        if duration is not None:
+            fields['duration'] = duration
+        with self.lock:
+            self.events.append(fields)
+            if len(self.events) > MAX_EVENTS:
+                del self.events[:len(self.events) - MAX_EVENTS]
+        return fields
+
+    # 记录 with 块的耗时，块中可以向产生的字典添加字段；出现异常时记录 status=error 并继续抛出
+    @contextlib.contextmanager
+    def timed(self, event, **fields):
+        start = time.time()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.setdefault('status', 'error')
+            fields.setdefault('error', str(e) or e.__class__.__name__)
+            raise
+        finally:
+            self.record(event, time.time() - start, **fields)
+
+    # 取出并清空已记录的事件
+    def drain(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+
+# 进程内共享的实例
+metrics = Metrics()
+record = metrics.record
+timed = metrics.timed
+
+
+def _abspath(app_root, path):
+    return path if os.path.isabs(path) else os.path.join(app_root, path)
+
+
+# 导出并清空已记录的事件：log 为 JSON lines 日志路径，textfile 为 Prometheus textfile collector 读取的文件
+# 相对路径以项目目录为基准，均为空时只清空；导出失败只输出警告，不影响命令本身
+def flush(app_root, log='', textfile=''):
+    events = metrics.drain()
+    if not events or not (log or textfile):
+        return
+    import json
+    data_dir = os.path.join(app_root, 'data')
+    try:
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        with FileLock(os.path.join(data_dir, LOCK_NAME)):
+            if log:
+                with open(_abspath(app_root, log), 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event, sort_keys=True) + '\n')
+            if textfile:
+                state = aggregate(_load_state(data_dir), events)
+                _write_atomic(os.path.join(data_dir, STATE_NAME), json.dumps(state, indent=4, sort_keys=True))
+                _write_atomic(_abspath(app_root, textfile), format_prometheus(state))
+    except (IOError, OSError) as e:
+        sys.stderr.write('*** Warning: failed exporting metrics: %s\n' %e)
+
+
+def _load_state(data_dir):
+    import json
+    try:
+        with open(os.path.join(data_dir, STATE_NAME), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+# textfile collector 可能随时读取，必须写入同目录的临时文件后整体替换
+def _write_atomic(path, content):
+    fd, tmp_file = tempfile.mkstemp(prefix='.metrics.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        replace_file(tmp_file, path)
+    except BaseException:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+# 将事件累加到 state：{事件名: {标签串: {labels, count, duration_sum, last_duration, bytes_sum, last_time}}}
+def aggregate(state, events):
+    for event in events:
+        labels = dict((k, str(event[k])) for k in LABELS if event.get(k) is not None)
+        key = ','.join('%s=%s' %item for item in sorted(labels.items()))
+        series = state.setdefault(event['event'], {}).setdefault(key, {'labels': labels, 'count': 0,
+            'duration_sum': 0.0, 'last_duration': None, 'bytes_sum': 0, 'last_time': None})
+        series['count'] += 1
+        series['last_time'] = event['time']
+        if event.get('duration') is not None:
+            series['duration_sum'] += event['duration']
+            series['last_duration'] = event['duration']
+        series['bytes_sum'] += event.get('bytes') or 0
+    return state
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' %','.join('%s="%s"' %(k, escape(v)) for k, v in sorted(labels.items()))
+
+
+# 按 Prometheus 文本格式输出：每种事件的次数、总耗时、最近一次的耗时和时间，以及传输的字节数
+def format_prometheus(state):
+    lines = []
+    for event in sorted(state):
+        name = METRIC_PREFIX + event.replace('-', '_')
+        series = [state[event][key] for key in sorted(state[event])]
+        families = (
+            ('_total', 'counter', 'Number of %s operations.', lambda s: s['count']),
+            ('_duration_seconds_total', 'counter', 'Total seconds spent in %s.', lambda s: s['duration_sum']),
+            ('_last_duration_seconds', 'gauge', 'Seconds spent in the last %s.', lambda s: s['last_duration']),
+            ('_last_timestamp_seconds', 'gauge', 'Unix time of the last %s.', lambda s: s['last_time']),
+            ('_bytes_total', 'counter', 'Bytes transferred by %s.', lambda s: s['bytes_sum'] or None),
+        )
+        for suffix, kind, help_text, value in families:
+            samples = [(s['labels'], value(s)) for s in series if value(s) is not None]
+            if not samples:
+                continue
+            lines.append('# HELP %s%s %s' %(name, suffix, help_text %event))
+            lines.append('# TYPE %s%s %s' %(name, suffix, kind))
+            for labels, v in samples:
+                lines.append('%s%s%s %s' %(name, suffix, _format_labels(labels), repr(float(v))))
+    return '\n'.join(lines) + '\n'
+
+
+# 在 cProfile 和 tracemalloc 下执行 func，统计结果保存到 out_dir/<时间>-<label>.prof 和 .txt
+# 工作线程（如并发拉取）各自使用一个 profiler，结束后与主线程的结果合并
+def profile(func, out_dir, label='hman'):
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    thread_profilers = []
+
+    def start_thread_profiler(frame, event, arg):
+        sys.setprofile(None)
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            # 新版本的 cProfile 同一时间只能启用一个，此时主线程的 profiler 已经覆盖所有线程
+            return
+        thread_profilers.append(thread_profiler)
+
+    if tracemalloc is not None:
+        tracemalloc.start(PROFILE_FRAMES)
+    threading.setprofile(start_thread_profiler)
+    start = time.time()
+    try:
+        return profiler.runcall(func)
+    finally:
+        elapsed = time.time() - start
+        threading.setprofile(None)
+        snapshot = peak = None
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        prefix = os.path.join(out_dir, '%s-%s' %(time.strftime('%Y%m%d-%H%M%S'), label))
+        stats = pstats.Stats(profiler, *thread_profilers)
+        stats.dump_stats(prefix + '.prof')
+        with open(prefix + '.txt', 'w') as f:
+            f.write('Elapsed %.3fs in %d thread(s)\n' %(elapsed, len(thread_profilers) + 1))
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(PROFILE_LIMIT)
+            stats.sort_stats('tottime').print_stats(PROFILE_LIMIT)
+            if snapshot is not None:
+                f.write('Peak traced memory: %.1f MiB\nTop allocations:\n' %(peak / 1048576.0))
+                for stat in snapshot.statistics('traceback')[:PROFILE_MEMORY_LIMIT]:
+                    f.write('%s\n' %stat)
+                    for line in stat.traceback.format()[-4:]:
+                        f.write('    %s\n' %line.strip())
+        memory = ', peak memory %.1f MiB' %(peak / 1048576.0) if peak is not None else ''
+        sys.stderr.write('Profiled %.3fs%s. Stats saved to %s.prof (pstats) and %s.txt\n'
+            %(elapsed, memory, prefix, prefix))
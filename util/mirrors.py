@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import random
+import tempfile
+
+from util.fsutil import replace_file
+
+STATS_NAME = 'mirrors.json'
+# 延迟的指数移动平均系数，越大越偏向最近一次的结果
+LATENCY_WEIGHT = 0.3
+
+
+# 源配置中的 url 可以是单个地址，也可以是同一份 hosts 的多个镜像地址
+def source_urls(url):
+    if isinstance(url, (list, tuple)):
+        return [u for u in url if u]
+    return [url]
+
+
+# 第 attempt 次重试前等待的秒数：指数退避，上限为 cap，并在 [delay/2, delay] 内随机抖动
+def backoff_delay(attempt, base, cap):
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2.0, delay)
+
+
+class MirrorStats(object):
+    """Per-mirror latency and success statistics of a source, kept in `data/<name>/mirrors.json`.
+    Used to try the fastest healthy mirror first.\n"""
+    def __init__(self, working_dir):
+        self.stats_file = os.path.join(working_dir, STATS_NAME)
+        self.stats = self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.stats_file):
+            return {}
+        try:
+            with open(self.stats_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def save(self):
+        fd, tmp_file = tempfile.mkstemp(prefix='.mirrors.', suffix='.tmp', dir=os.path.dirname(self.stats_file))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.stats, f, indent=4, sort_keys=True)
+        replace_file(tmp_file, self.stats_file)
+
+    def _get(self, url):
+        return self.stats.setdefault(url, {'ok': 0, 'failed': 0, 'streak': 0, 'latency': None,
+            'last_success': None, 'last_failure': None, 'last_error': ''})
+
+    # 记录一次成功的请求，latency 为收到响应头所用的秒数
+    def record_success(self, url, latency):
+        stat = self._get(url)
+        stat['ok'] += 1
+        stat['streak'] = 0
+        stat['last_success'] = time.time()
+        if stat['latency'] is None:
+            stat['latency'] = latency
+        else:
+            stat['latency'] = (1 - LATENCY_WEIGHT) * stat['latency'] + LATENCY_WEIGHT * latency
+
+    # 记录一次失败，streak 为连续失败的次数
+    def record_failure(self, url, error):
+        stat = self._get(url)
+        stat['failed'] += 1
+        stat['streak'] += 1
+        stat['last_failure'] = time.time()
+        stat['last_error'] = str(error) or error.__class__.__name__
+
+    # 镜像的尝试顺序：最近一次成功的按平均延迟从低到高，连续失败的按失败次数排在后面
+    # 还没有延迟记录的镜像排在健康镜像的最前面，使每个镜像都能被测到；其余情况保持配置中的顺序
+    def order(self, urls):
+        def key(item):
+            index, url = item
+            stat = self.stats.get(url, {})
+            return (stat.get('streak', 0), stat.get('latency') or 0, index)
+        return [url for _, url in sorted(enumerate(urls), key=key)]
@@ -1,8 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import re
+import shlex
 import functools
 
+# 表示“全部”的参数，如 `pull *`
+ALL_ALIASES = ('*', '-a', '--all')
+
+
+# 按 shell 的规则拆分参数，可以用引号传入含空格的参数；引号不成对时按空白拆分
+def split_line(line):
+    try:
+        return shlex.split(line)
+    except ValueError:
+        return line.split()
+
+
 class Validator(object):
     """Base validator class"""
     def __init__(self, base=None):
@@ -20,7 +33,7 @@ class Validator(object):
 
 class Choice(Validator):
     """Validator for choosing an option from a list"""
-    def __init__(self, base=None, _all=('*', '-a', '--all')):
+    def __init__(self, base=None, _all=ALL_ALIASES):
         Validator.__init__(self, base)
         self.all = tuple([_all]) if type(_all)==str else tuple(_all)
 
@@ -34,6 +47,21 @@ class Choice(Validator):
             %(param_name, self.base, param_value))
 
 
+class NameChoice(Choice):
+    """Validator for choosing exactly one option, the all-aliases are not accepted"""
+    def __init__(self, base=None):
+        Choice.__init__(self, base, _all=())
+
+
+class VersionedChoice(Choice):
+    """Validator for choosing an option, optionally suffixed with @version"""
+    def validate(self, test):
+        name, sep, _ = test.partition('@')
+        if sep:
+            return name in self.base
+        return Choice.validate(self, test)
+
+
 class Equal(Validator):
     """Validator for exactly equal"""
     def validate(self, test):
@@ -62,6 +90,7 @@ class FromObj(object):
         return self.func(obj)
 
 
+# 参数校验失败时被装饰的方法不会执行，包装函数返回 False
 def parameter(name, required=False, validator=None, special_type=None):
     def decorator(method):
         # print('In method: %s -- %s' %(method.__name__, validator))
@@ -70,7 +99,7 @@ def parameter(name, required=False, validator=None, special_type=None):
             # 多级 parameter 装饰器串联时，接收上一级已经解析好的参数
             if parsed_params == None:
                 parsed_params = []
-            params = line.split() if type(line)==str else line
+            params = split_line(line) if type(line)==str else line
 
             # parameter_over 装饰器阻止解析接下来的参数
             if special_type == '__over__':
@@ -92,7 +121,7 @@ def parameter(name, required=False, validator=None, special_type=None):
                 for p in params:
                     if not vld.validate(p):
                         vld.invalid_message(name, p)
-                        return
+                        return False
                 parsed_params.append(params)
                 return method(obj, *parsed_params)
 
@@ -101,7 +130,7 @@ def parameter(name, required=False, validator=None, special_type=None):
             if not line:
                 if required:
                     vld.required_message(name)
-                    return
+                    return False
             else:
                 p = params[0]
 
@@ -109,7 +138,7 @@ def parameter(name, required=False, validator=None, special_type=None):
             need_validate = required or (p != '')
             if need_validate and (not vld.validate(p)):
                 vld.invalid_message(name, p)
-                return
+                return False
 
             # 多级 parameter 装饰器串联时，进入下一级
             parsed_params.append(p)
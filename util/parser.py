@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import io
+import re
+
+from util import compression
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 内置 intern
+    pass
+
+
+class HostsEntry(object):
+    """One mapping line of a hosts file: an IP and the hostnames it maps.\n"""
+    __slots__ = ('ip', 'hostnames', 'comment')
+
+    def __init__(self, ip, hostnames, comment=''):
+        self.ip = ip
+        self.hostnames = hostnames
+        self.comment = comment
+
+    def __repr__(self):
+        return 'HostsEntry(%r, %r, %r)' %(self.ip, self.hostnames, self.comment)
+
+    def __eq__(self, other):
+        return isinstance(other, HostsEntry) and self.ip == other.ip and self.hostnames == other.hostnames
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    # 还原为 hosts 文件中的一行（不含换行符）
+    def to_line(self):
+        line = self.ip + ' ' + ' '.join(self.hostnames)
+        if self.comment:
+            line += ' # ' + self.comment
+        return line
+
+
+# 解析一行 hosts，返回 (ip, hostnames, comment)；空行、注释行或不完整的行返回 None
+# ip 和主机名统一转为小写并做 intern，以便在大量重复时节省内存
+def parse_line(line):
+    body, _, comment = line.partition('#')
+    fields = body.lower().split()
+    if len(fields) < 2:
+        return None
+    return intern(fields[0]), tuple(map(intern, fields[1:])), comment.strip()
+
+
+# 逐行解析，生成 HostsEntry；lines 可以是任意可迭代的文本行
+def iter_entries(lines):
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is not None:
+            yield HostsEntry(*parsed)
+
+
+# 以文本行方式流式读取 hosts 文件（支持压缩缓存），保留原有的换行符
+def iter_lines(path):
+    with compression.open_read(path) as f:
+        for line in io.TextIOWrapper(f, encoding='utf8', newline=''):
+            yield line
+
+
+def iter_file(path):
+    return iter_entries(iter_lines(path))
+
+
+# 空行和注释行的开头，用于 b'\n' + 若干整行的内容；以换行符开头，re 可以直接查找换行符而不必逐字节尝试
+SKIPPED_LINE_PATTERN = re.compile(br'\n[ \t]*(?=[#\n\r\f\v]|\Z)')
+
+
+# 整行内容 block 中映射行（非空、不以 # 开头）的个数，最后一行可以没有换行符
+def count_mapping_lines(block):
+    if block.endswith(b'\n'):
+        block = block[:-1]
+    elif not block:
+        return 0
+    return block.count(b'\n') + 1 - len(SKIPPED_LINE_PATTERN.findall(b'\n' + block))
+
+
+class EntryCounter(object):
+    """Counts mapping lines (non-blank, not starting with `#`) of a UTF-8 stream fed
+    in chunks, with a regex over whole lines instead of parsing each line.\n"""
+
+    def __init__(self):
+        self.count = 0
+        self._tail = b''
+
+    def feed(self, data):
+        data = self._tail + data
+        cut = data.rfind(b'\n') + 1
+        self._tail = data[cut:]
+        if cut:
+            self.count += count_mapping_lines(data[:cut])
+
+    def finish(self):
+        self.count += count_mapping_lines(self._tail)
+        self._tail = b''
+        return self.count
+
+
+_VISITED = object()
+
+
+# 流式比较两个 hosts 文件，内存中只保存一份 {hostname: ip} 映射
+# 返回 (added, removed, changed)：[(hostname, ip)]、[(hostname, ip)]、[(hostname, old_ip, new_ip)]
+# IPv4 与 IPv6 映射分开比较
+def diff_files(old_path, new_path):
+    return diff_entries(iter_file(old_path), iter_file(new_path))
+
+
+# 同 diff_files，比较的是两个 HostsEntry 序列
+def diff_entries(old_entries, new_entries):
+    maps = ({}, {})
+    for entry in old_entries:
+        mapping = maps[':' in entry.ip]
+        for hostname in entry.hostnames:
+            mapping.setdefault(hostname, entry.ip)
+    added, changed = [], []
+    for entry in new_entries:
+        mapping = maps[':' in entry.ip]
+        for hostname in entry.hostnames:
+            ip = mapping.get(hostname)
+            if ip is _VISITED:
+                continue
+            mapping[hostname] = _VISITED
+            if ip is None:
+                added.append((hostname, entry.ip))
+            elif ip != entry.ip:
+                changed.append((hostname, ip, entry.ip))
+    removed = [(h, ip) for mapping in maps for h, ip in mapping.items() if ip is not _VISITED]
+    return added, removed, changed
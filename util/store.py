@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+import contextlib
+
+from util.filelock import FileLock, LockTimeout, LOCK_TIMEOUT
+from util.fsutil import replace_file
+
+STORE_NAME = 'config.json'
+LOCK_NAME = '.config.lock'
+# 旧版本分散在 data/<name>/ 下的元数据文件，迁移到存储中后删除
+LEGACY_MD5 = 'md5.txt'
+LEGACY_VALIDATORS = 'validators.json'
+LEGACY_META = 'meta.json'
+
+
+class ConfigStore(object):
+    """Configuration and per-source metadata in `data/config.json`.
+
+    The file holds `sources`, `current`, `versions` (saved versions in use), `settings`
+    and `meta` (per-source digest, validators, size, entry count and pull times). Every change runs in `transaction()`:
+    the file is re-read under an exclusive lock and atomically replaced afterwards,
+    so concurrent hman processes never lose each other's changes. `data/` is created on the
+    first write, reading works without it.\n"""
+    def __init__(self, app_root, lock_timeout=LOCK_TIMEOUT):
+        self.data_dir = os.path.join(app_root, 'data')
+        self.path = os.path.join(self.data_dir, STORE_NAME)
+        self.lock = FileLock(os.path.join(self.data_dir, LOCK_NAME), timeout=lock_timeout)
+
+    # 读取当前内容，文件不存在时返回空字典；写入是原子的，读取不需要加锁
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError as e:
+            raise ValueError('Invalid config file %s: %s' %(self.path, e))
+
+    def _make_data_dir(self):
+        if not os.path.isdir(self.data_dir):
+            os.makedirs(self.data_dir)
+
+    def _write(self, state):
+        self._make_data_dir()
+        fd, tmp_file = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=self.data_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f, indent=4, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            replace_file(tmp_file, self.path)
+        except BaseException:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    # 加锁读取最新内容，with 块中修改 state，正常结束时写回；出现异常时不写入
+    # 等待锁超过 lock_timeout 秒时抛出 LockTimeout
+    @contextlib.contextmanager
+    def transaction(self):
+        self._make_data_dir()
+        try:
+            self.lock.acquire()
+        except LockTimeout:
+            raise LockTimeout('Timed out after %ss waiting for another hman process to release %s, '
+                'stop that process and retry' %(self.lock.timeout, self.lock.path))
+        try:
+            state = self.read()
+            yield state
+            self._write(state)
+        finally:
+            self.lock.release()
+
+    def get_meta(self, name):
+        return self.read().get('meta', {}).get(name, {})
+
+    # 更新一个源的元数据，值为 None 的项被删除
+    def update_meta(self, name, values):
+        with self.transaction() as state:
+            meta = state.setdefault('meta', {}).setdefault(name, {})
+            meta.update(values)
+            for key in [k for k, v in meta.items() if v is None]:
+                del meta[key]
+
+    # 将旧版本 data/<name>/ 下的 md5.txt、validators.json、meta.json 合并到 state['meta'] 并删除
+    def migrate_legacy_meta(self, state, names):
+        for name in names:
+            working_dir = os.path.join(self.data_dir, name)
+            meta = state.setdefault('meta', {}).setdefault(name, {})
+            path = os.path.join(working_dir, LEGACY_MD5)
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    meta.setdefault('digest', f.read().strip() or None)
+            for legacy in (LEGACY_VALIDATORS, LEGACY_META):
+                path = os.path.join(working_dir, legacy)
+                if os.path.isfile(path):
+                    try:
+                        with open(path, 'r') as f:
+                            for key, value in json.load(f).items():
+                                meta.setdefault(key, value)
+                    except ValueError:
+                        pass
+            if not meta:
+                del state['meta'][name]
+        # 先写入新的存储，再删除旧文件
+        self._write(state)
+        for name in names:
+            for legacy in (LEGACY_MD5, LEGACY_VALIDATORS, LEGACY_META):
+                path = os.path.join(self.data_dir, name, legacy)
+                if os.path.isfile(path):
+                    os.remove(path)
@@ -3,19 +3,41 @@
 import os
 import sys
 import time
+import errno
 import platform
 import hashlib
 import shutil
 import logging
 import codecs
+import io
+import threading
+import json
+import tempfile
+import filecmp
+import mmap
+import functools
+
+from util import compression
+from util import httpclient
+from util import encoding
+from util import mirrors
+from util import hooks
+from util import metrics
+from util.filters import HostsFilter
+from util.validator import Validator, ValidationError, format_report, MAX_SHRINK, MAX_INVALID_RATIO
+from util.lookup import LookupIndex
+from util.history import SourceHistory, HISTORY_KEEP
+from util.store import ConfigStore
+from util.backup import BackupStore
+from util.fsutil import replace_file
+from util.filelock import FileLock, LockTimeout, LOCK_TIMEOUT
+from util import merger
+from util import parser
 
-# import urllib
 try:
-    # For Python 3
-    from urllib.request import urlopen
+    import queue
 except ImportError:
-    # Fall back to Python 2
-    from urllib2 import urlopen
+    import Queue as queue
 
 SEPARATOR = '# -------------------- Modified -------------------- #'
 
@@ -43,21 +65,109 @@ INITIAL_HOSTS = '''# Copyright (c) 1993-2009 Microsoft Corp.
 
 '''
 
+# 日志的输出方式由 hman.main 设置，作为库导入时不添加 handler
 logger = logging.getLogger('HostsUpdator')
-logger.setLevel(logging.INFO)
-hd = logging.StreamHandler()
-# formatter = logging.Formatter('[%(asctime)s] %(name)s: %(levelname)s: %(message)s')
-formatter = logging.Formatter(fmt='[%(asctime)s]:%(levelname)s: %(message)s',datefmt='%Y-%m-%d %H:%M:%S')
-hd.setFormatter(formatter)
-logger.addHandler(hd)
+
+# 下载超时时间（秒），分别为建立连接和读取数据的超时
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+# 流式下载时每次读取的字节数
+CHUNK_SIZE = 64 * 1024
+
+
+# 渲染结果缓存保留的文件个数；渲染方式变化时递增 RENDER_VERSION 使旧缓存失效
+RENDER_CACHE_SIZE = 8
+RENDER_VERSION = 1
+
+# 备份保留策略：保留最近的若干个，以及最近若干天中每天最新的一个
+BACKUP_KEEP_LAST = 10
+BACKUP_KEEP_DAYS = 7
+
+# 拉取失败后的重试次数，以及指数退避的初始和最长等待时间（秒）
+PULL_RETRIES = 2
+RETRY_BACKOFF = 1
+RETRY_BACKOFF_MAX = 30
+# 并发拉取的线程数
+PULL_WORKERS = 4
+
+# 切换 hosts 时持有的全局锁，以及拉取单个源时持有的锁
+INSTALL_LOCK = os.path.join('data', '.install.lock')
+PULL_LOCK = '.pull.lock'
+
+
+# 在持有文件锁时执行方法，lock_path(updator) 返回锁文件路径；需要等待时先输出提示
+def locked(lock_path):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            lock = FileLock(lock_path(self), timeout=self.lock_timeout)
+            try:
+                lock.acquire(timeout=0)
+            except LockTimeout:
+                logger.info('Waiting for another hman process to finish with %s ...' %lock.path)
+                lock.acquire()
+            try:
+                return method(self, *args, **kw)
+            finally:
+                lock.release()
+        return wrapper
+    return decorator
+
+
+def install_lock_path(updator):
+    return os.path.join(updator.app_root, INSTALL_LOCK)
+
+
+# 拉取锁在源的工作目录中，首次拉取时才创建该目录
+def pull_lock_path(updator):
+    if not os.path.isdir(updator.working_dir):
+        os.makedirs(updator.working_dir)
+    return os.path.join(updator.working_dir, PULL_LOCK)
+
 
 class HostsUpdator(object):
     """Class to download and update hosts file.\n"""
-    def __init__(self, source_name, source_url, app_root):
+    def __init__(self, source_name, source_url, app_root,
+            connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, cache_format='',
+            render_cache_size=RENDER_CACHE_SIZE, verify_install=False,
+            backup_keep_last=BACKUP_KEEP_LAST, backup_keep_days=BACKUP_KEEP_DAYS, client=None,
+            retries=PULL_RETRIES, retry_backoff=RETRY_BACKOFF, retry_backoff_max=RETRY_BACKOFF_MAX,
+            race_mirrors=False, after_use_hooks='auto', filters=None, store=None,
+            lock_timeout=LOCK_TIMEOUT, validate_pull=True, max_shrink=MAX_SHRINK,
+            max_invalid_ratio=MAX_INVALID_RATIO, history_keep=HISTORY_KEEP):
+        compression.check_cache_format(cache_format)
         self.name = source_name
-        self.url = source_url
+        # source_url 可以是多个镜像地址的列表，self.url 为配置中的第一个
+        self.urls = mirrors.source_urls(source_url)
+        self.url = self.urls[0]
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.cache_format = cache_format
+        self.render_cache_size = render_cache_size
+        self.verify_install = verify_install
+        self.backup_keep_last = backup_keep_last
+        self.backup_keep_days = backup_keep_days
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.race_mirrors = race_mirrors
+        self.after_use_hooks = after_use_hooks
+        self.lock_timeout = lock_timeout
+        # 拉取到的新内容经过校验才会替换本地缓存，None 表示不校验
+        self.validator = Validator(max_shrink, max_invalid_ratio) if validate_pull else None
+        # 每次拉取到新内容时保存的历史版本数，0 表示不保存；version 不为 None 时安装该历史版本而不是最新内容
+        self.history_keep = history_keep
+        self.version = None
+        # 安装时的过滤规则 {'allow': [...], 'deny': [...]}，在这里编译一次以便尽早发现错误的规则
+        self.filters = dict((k, list((filters or {}).get(k) or [])) for k in ('allow', 'deny'))
+        HostsFilter(**self.filters)
+        # 默认使用进程内共享的 HTTP 客户端，同一源站的多个源复用 keep-alive 连接
+        self.client = client or httpclient.shared_client()
         self.system = platform.system()
         self.app_root = app_root
+        # 源的元数据（md5、ETag、大小、条目数、拉取时间）保存在 data/config.json 中
+        self.store = store or ConfigStore(app_root)
         self.hosts_dir = self._get_hosts_dir()
         self.working_dir = self._get_working_dir()
 
@@ -71,25 +181,9 @@ class HostsUpdator(object):
         raise Exception('System type error: unknown system: %s' %self.system)
 
 
-    # 获取当前源的数据目录
+    # 获取当前源的数据目录，首次拉取时才创建（见 pull_lock_path），只读的命令不写入 data/
     def _get_working_dir(self):
-        working_dir = os.path.join(self.app_root, 'data', self.name)
-        if not os.path.isdir(working_dir):
-            os.makedirs(working_dir)
-        return working_dir
-
-
-    @staticmethod
-    def safe_write(fobj, data):
-        # python 3: "write" method requires str, not bytes
-        try:
-            fobj.write(data)
-        except (TypeError, UnicodeDecodeError) as e:
-            fobj.write(data.decode('utf8'))
-        except UnicodeDecodeError as e:
-            fobj.write(data.decode('gbk'))
-        except UnicodeDecodeError as e:
-            fobj.write(data.decode('utf8', errors='ignore'))
+        return os.path.join(self.app_root, 'data', self.name)
 
 
     # 判断 hosts 是否存在
@@ -108,53 +202,359 @@ class HostsUpdator(object):
 
 
     # 从远端下载 hosts 文件
+    # 源有多个镜像时按 MirrorStats 的顺序依次尝试，全部失败后指数退避并重试，最多重试 retries 次
+    # race_mirrors 为真时同时请求所有镜像，使用最先返回的响应
+    # 同一个源同时只有一个进程在拉取，不同的源可以并行拉取
+    @locked(pull_lock_path)
     def pull(self):
-        # 获取上次更新时记录的 md5 码
-        def get_last_md5(md5_file):
-            last_md5 = ''
-            if os.path.isfile(md5_file):
-                with open(md5_file, 'r') as f:
-                    last_md5 = f.read().strip()
-            return last_md5
-
-        def update_md5(md5_file, md5):
-            with open(md5_file, 'w') as f:
-                f.write(md5)
-
-        logger.info('Downloading hosts from source [%s]: %s ...' %(self.name, self.url))
-        data = urlopen(self.url).read()
-        md5 = hashlib.md5(data).hexdigest()
-        md5_file = os.path.join(self.working_dir, 'md5.txt')
-        last_md5 = get_last_md5(md5_file)
-        if md5 == last_md5:
-            logger.info('Hosts is already up-to-date with source [%s]. Quit updating!' %self.name)
-            return
-        hosts_download = os.path.join(self.working_dir, 'hosts.txt')
-        with codecs.open(hosts_download, 'w', encoding='utf8') as f:
-            self.safe_write(f, data)
-        update_md5(md5_file, md5)
+        hosts_download = compression.cache_path(self.working_dir, self.cache_format)
+        meta = self.store.get_meta(self.name)
+        # 本地已有缓存时发送条件请求，源未变化则服务器返回 304 而不传输内容
+        headers = self.conditional_headers(meta if os.path.isfile(hosts_download) else {})
+        headers['Accept-Encoding'] = compression.ACCEPT_ENCODING
+        stats = mirrors.MirrorStats(self.working_dir)
+        # 返回非临时性错误（如 404）的镜像在本次拉取中不再尝试
+        broken = set()
+        error = failed_url = None
+        try:
+            for attempt in range(self.retries + 1):
+                urls = [u for u in stats.order(self.urls) if u not in broken]
+                if not urls:
+                    break
+                if attempt:
+                    delay = mirrors.backoff_delay(attempt, self.retry_backoff, self.retry_backoff_max)
+                    logger.warning('Retrying source [%s] in %.1fs (%d/%d), last tried %s: %s'
+                        %(self.name, delay, attempt, self.retries, failed_url, error))
+                    time.sleep(delay)
+                # 竞速时只尝试一次，由 race 同时请求所有镜像
+                racing = self.race_mirrors and len(urls) > 1
+                for url in ([None] if racing else urls):
+                    try:
+                        if racing:
+                            logger.info('Downloading hosts from source [%s], racing %s ...' %(self.name, ', '.join(urls)))
+                            url, response = self.race(urls, headers, stats, broken)
+                        else:
+                            logger.info('Downloading hosts from source [%s]: %s ...' %(self.name, url))
+                            response = self.fetch(url, headers, stats)
+                        result = self.save_response(response, hosts_download, meta)
+                    except Exception as e:
+                        url = getattr(e, 'mirror_url', url)
+                        if not getattr(e, 'recorded', False):
+                            stats.record_failure(url, e)
+                        if len(self.urls) > 1:
+                            logger.warning('Failed pulling source [%s] from %s: %s' %(self.name, url, e))
+                        if not self.is_transient(e):
+                            broken.add(url)
+                        # 最后一个出错的镜像，供 pull_many 输出和记录
+                        e.mirror_url = url
+                        error, failed_url = e, url
+                        continue
+                    result.update({'url': url, 'attempts': attempt + 1})
+                    if result['status'] == 'updated' and self.history_keep:
+                        self.update_history()
+                    return result
+        finally:
+            stats.save()
+        raise error
+
+
+    def history(self):
+        return SourceHistory(self.working_dir, self.history_keep)
+
+
+    # 拉取到新内容后保存为历史版本，失败不影响拉取结果
+    def update_history(self):
+        try:
+            meta = self.store.get_meta(self.name)
+            self.history().add(compression.find_cache(self.working_dir), meta['digest'], meta.get('entries'))
+        except Exception as e:
+            logger.warning('Failed saving history of source [%s]: %s' %(self.name, e))
+
+
+    # 请求单个镜像并记录其延迟，失败时记录到 stats，并在异常上标记出错的镜像
+    def fetch(self, url, headers, stats):
+        start = time.time()
+        try:
+            response = self.client.get(url, headers,
+                connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+        except Exception as e:
+            stats.record_failure(url, e)
+            e.mirror_url, e.recorded = url, True
+            raise
+        stats.record_success(url, time.time() - start)
+        return response
+
+
+    # 同时请求多个镜像，返回最先成功的 (url, response)，其余镜像的响应到达后直接关闭连接
+    # 所有镜像都失败时抛出最后一个错误，返回非临时性错误的镜像加入 broken
+    def race(self, urls, headers, stats, broken):
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {'done': False}
+
+        def attempt(url):
+            start = time.time()
+            try:
+                response = self.client.get(url, headers,
+                    connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+            except Exception as e:
+                results.put((url, None, e, time.time() - start))
+                return
+            with lock:
+                if not state['done']:
+                    results.put((url, response, None, time.time() - start))
+                    return
+            response.close()
+
+        for url in urls:
+            t = threading.Thread(target=attempt, args=(url,))
+            t.daemon = True
+            t.start()
+        error = None
+        for _ in urls:
+            url, response, error, elapsed = results.get()
+            if response is None:
+                stats.record_failure(url, error)
+                error.mirror_url, error.recorded = url, True
+                if not self.is_transient(error):
+                    broken.add(url)
+                continue
+            stats.record_success(url, elapsed)
+            with lock:
+                state['done'] = True
+                while not results.empty():
+                    _, other, _, _ = results.get_nowait()
+                    if other is not None:
+                        other.close()
+            logger.info('Mirror %s of source [%s] responded first' %(url, self.name))
+            return url, response
+        raise error
+
+
+    # 服务器错误、网络错误和超时可以重试，其他错误（如 404、不支持的地址）重试也不会成功
+    @staticmethod
+    def is_transient(error):
+        # 校验失败说明服务器返回的就是有问题的内容，马上重试也不会改变
+        if isinstance(error, ValidationError):
+            return False
+        if isinstance(error, httpclient.HttpError):
+            return error.code in httpclient.RETRYABLE_CODES
+        return not isinstance(error, ValueError)
+
+
+    # 将响应保存为本地缓存并更新元数据，返回 {'status', 'code', 'bytes', 'timing'}
+    # last_meta 为上次拉取时记录的元数据；内容未通过校验时抛出 ValidationError，保留原有的缓存
+    def save_response(self, response, hosts_download, last_meta):
+        timing, code = response.timing, response.status
+        now = time.time()
+        if code == 304:
+            response.read()
+            response.close()
+            self.store.update_meta(self.name, {'last_pull': now})
+            logger.info('Hosts is not modified since last pull from source [%s]. Quit updating!' %self.name)
+            return {'status': 'not-modified', 'code': code, 'bytes': 0, 'timing': timing}
+        # 分块下载、解压并统一转换为 utf-8 和 \n 换行后写入临时文件，同时计算 md5 和条目数，内存占用与源的大小无关
+        # md5 基于转换后的内容计算，与传输及缓存的压缩格式无关
+        fd, tmp_file = tempfile.mkstemp(prefix='.hosts.', suffix='.tmp', dir=self.working_dir)
+        os.close(fd)
+        try:
+            try:
+                headers = response.info()
+                response = compression.DecodedResponse(response, headers.get('Content-Encoding'))
+                normalizer = encoding.Utf8Normalizer()
+                # 校验与下载同时进行，不必再读一遍文件；校验时条目数取自校验报告，不再单独计数
+                counter = checker = None
+                if self.validator is not None:
+                    checker = self.validator.stream(last_meta.get('entries') if os.path.isfile(hosts_download) else None)
+                else:
+                    counter = parser.EntryCounter()
+                with compression.open_write(tmp_file, self.cache_format) as f:
+                    md5, length = self.stream_to(response, f, normalizer, counter, checker)
+                size = response.transferred
+            finally:
+                response.close()
+            # 服务器未提供 ETag/Last-Modified 时，仍以 md5 判断内容是否变化
+            if md5 == last_meta.get('digest') and os.path.isfile(hosts_download):
+                os.remove(tmp_file)
+                meta = self.validators_from(headers)
+                meta['last_pull'] = now
+                self.store.update_meta(self.name, meta)
+                logger.info('Hosts is already up-to-date with source [%s]. Quit updating!' %self.name)
+                return {'status': 'unchanged', 'code': code, 'bytes': size, 'timing': timing}
+            if checker is not None:
+                entries = self.check_report(checker.finish())['entries']
+            else:
+                entries = counter.count
+            replace_file(tmp_file, hosts_download)
+            compression.remove_stale_caches(self.working_dir, hosts_download)
+        except BaseException:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            raise
+        # hosts.txt 写入完成后才记录 md5 和校验信息，避免中断后下次请求得到 304 而保留旧内容
+        meta = self.validators_from(headers)
+        meta.update({'digest': md5, 'size': length, 'entries': entries,
+            'encoding': normalizer.encoding, 'last_pull': now, 'last_change': now})
+        self.store.update_meta(self.name, meta)
         logger.info('Success pulling hosts from source [%s]' %self.name)
+        return {'status': 'updated', 'code': code, 'bytes': size, 'timing': timing}
+
+
+    # 根据拉取到的内容的校验报告（见 util/validator.py），有问题时输出摘要，应当拒绝时抛出 ValidationError
+    def check_report(self, report):
+        if report['errors']:
+            for lineno, reason, line in report['samples']:
+                logger.warning('Source [%s] line %d, %s: %s' %(self.name, lineno, reason, line[:100]))
+            raise ValidationError('Rejected content of source [%s]: %s' %(self.name, '; '.join(report['errors'])), report)
+        if report['malformed'] or report['invalid_ip'] or report['invalid_hostname']:
+            logger.warning('Source [%s]: %s' %(self.name, format_report(report)))
+        return report
+
+
+    # 将响应内容分块经 normalizer 转换后写入文件对象，返回写入内容的 (md5, 字节数)
+    # counter 为 parser.EntryCounter 时同时统计写入的条目数，checker 为 validator.ContentChecker 时同时校验
+    @staticmethod
+    def stream_to(response, fobj, normalizer, counter=None, checker=None, chunk_size=CHUNK_SIZE):
+        md5 = hashlib.md5()
+        length = 0
+        while True:
+            chunk = response.read(chunk_size)
+            data = normalizer.feed(chunk) if chunk else normalizer.finish()
+            md5.update(data)
+            length += len(data)
+            if counter is not None:
+                counter.feed(data)
+            if checker is not None:
+                checker.feed(data)
+            fobj.write(data)
+            if not chunk:
+                break
+        if counter is not None:
+            counter.finish()
+        return md5.hexdigest(), length
+
+
+    # 源的元数据，见 ConfigStore
+    def read_meta(self):
+        return self.store.get_meta(self.name)
+
+
+    # 服务器返回的 ETag/Last-Modified，没有的项为 None，更新元数据时会删除旧值
+    @staticmethod
+    def validators_from(headers):
+        return {'etag': headers.get('ETag') or None, 'last_modified': headers.get('Last-Modified') or None}
+
+
+    @staticmethod
+    def conditional_headers(validators):
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+
+    def backup_store(self):
+        return BackupStore(self.app_root, keep_last=self.backup_keep_last, keep_days=self.backup_keep_days)
 
 
-    # 备份 hosts 文件
+    # 备份 hosts 文件到 data/.backups/，相同内容只保存一份
     def backup_hosts(self):
         src = os.path.join(self.hosts_dir, 'hosts')
-        dst = os.path.join(self.hosts_dir, 'hosts.'+time.strftime('%Y%m%d.%H%M%S', time.localtime())+'.bak')
-        shutil.copy(src, dst)
-        logger.info('Success backing up hosts')
+        entry = self.backup_store().add(src)
+        logger.info('Success backing up hosts: %s (%s)' %(entry['time'], entry['digest'][:8]))
+
+
+    # 将系统 hosts 恢复为指定的备份，backup_id 为备份时间或内容 md5（前缀）
+    @locked(install_lock_path)
+    def restore(self, backup_id):
+        store = self.backup_store()
+        entry = store.find(backup_id)
+        hosts_file = os.path.join(self.hosts_dir, 'hosts')
+        blob = store.blob_path(entry['digest'])
+        if self.hosts_exists() and filecmp.cmp(blob, hosts_file, shallow=False):
+            logger.info('Hosts is already the same as backup %s. Quit restoring!' %entry['time'])
+            return False
+        if self.hosts_exists():
+            self.backup_hosts()
+        self.install(blob, hosts_file, require_separator=False)
+        self.clear_separator_offset()
+        self.after_use()
+        logger.info('Success restoring hosts from backup %s (%s)' %(entry['time'], entry['digest'][:8]))
+        return True
 
 
     # 获取并保留 hosts 文件头部用户自己定义的行
     # 用户定义的 hosts 以 SEPARATOR 行与程序注入的 hosts 分割
+    # 优先使用安装时记录的分隔行偏移，hosts 被外部修改过时在原始字节中查找分隔行
     def get_user_hosts(self):
         hosts_file = os.path.join(self.hosts_dir, 'hosts')
-        user_hosts = []
-        with codecs.open(hosts_file, 'r', encoding='utf8') as f:
-            line = f.readline()
-            while line and not line.startswith(SEPARATOR):
-                user_hosts.append(line)
-                line = f.readline()
-        return user_hosts
+        with metrics.timed('user-section', source=self.name) as event, open(hosts_file, 'rb') as f:
+            offset = self.read_separator_offset(hosts_file, f)
+            event['mode'] = 'offset' if offset is not None else 'scan'
+            if offset is None:
+                offset = self.find_separator(f)
+            f.seek(0)
+            user_section = f.read(offset) if offset is not None else f.read()
+            event['bytes'] = len(user_section)
+        return user_section.decode('utf8').splitlines(True)
+
+
+    # 在 hosts 原始字节中查找位于行首的分隔行，返回其偏移，找不到返回 None
+    @staticmethod
+    def find_separator(f):
+        separator = SEPARATOR.encode('utf8')
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data[:len(separator)] == separator:
+                return 0
+            offset = data.find(b'\n' + separator)
+            return offset + 1 if offset >= 0 else None
+        finally:
+            data.close()
+
+
+    def _separator_index_file(self):
+        return os.path.join(self.app_root, 'data', '.user-section.json')
+
+
+    # 安装后记录分隔行的偏移，以及 hosts 的大小、修改时间和用户部分的 md5，用于下次校验
+    def write_separator_offset(self, hosts_file, user_hosts):
+        user_section = ''.join(user_hosts).encode('utf8')
+        st = os.stat(hosts_file)
+        index = {'offset': len(user_section), 'size': st.st_size, 'mtime': st.st_mtime,
+            'md5': hashlib.md5(user_section).hexdigest()}
+        tmp_file = self._separator_index_file() + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        replace_file(tmp_file, self._separator_index_file())
+
+
+    def clear_separator_offset(self):
+        if os.path.isfile(self._separator_index_file()):
+            os.remove(self._separator_index_file())
+
+
+    # 读取记录的分隔行偏移，hosts 的大小、修改时间、分隔行或用户部分内容对不上时返回 None
+    def read_separator_offset(self, hosts_file, f):
+        try:
+            with open(self._separator_index_file(), 'r') as idx:
+                index = json.load(idx)
+        except (IOError, OSError, ValueError):
+            return None
+        st = os.fstat(f.fileno())
+        if (st.st_size, st.st_mtime) != (index.get('size'), index.get('mtime')):
+            return None
+        separator = SEPARATOR.encode('utf8')
+        f.seek(0)
+        user_section = f.read(index['offset'])
+        if f.read(len(separator)) != separator or hashlib.md5(user_section).hexdigest() != index.get('md5'):
+            return None
+        return index['offset']
 
 
     # 切换 hosts 源之前做一些准备工作，如初始化 hosts(如果不存在)、备份 hosts 等
@@ -164,29 +564,321 @@ class HostsUpdator(object):
         self.backup_hosts()
 
 
+    def has_cache(self):
+        return compression.find_cache(self.working_dir) is not None
+
+
+    # 获取当前源的本地缓存文件，未拉取过则报错；指定了 version 时返回解压出的历史版本
+    def cached_hosts(self):
+        if self.version is not None:
+            return self.history().checkout(self.version)
+        hosts_download = compression.find_cache(self.working_dir)
+        if hosts_download is None:
+            raise Exception('No cached hosts for source [%s], pull it first' %self.name)
+        return hosts_download
+
+
+    # 获取当前源内容的 md5，优先使用拉取时记录的 md5
+    def source_digest(self):
+        if self.version is not None:
+            return self.history().find(self.version)['digest']
+        md5 = self.store.get_meta(self.name).get('digest')
+        if md5:
+            return md5
+        md5 = hashlib.md5()
+        with compression.open_read(self.cached_hosts()) as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+
+    # 创建当前源的过滤器，没有过滤规则时返回 None
+    def make_filter(self):
+        hosts_filter = HostsFilter(**self.filters)
+        return hosts_filter if hosts_filter else None
+
+
+    # 渲染结果的缓存键：由用户自定义部分的内容和各个源（按顺序）的 md5 及过滤规则决定
+    @staticmethod
+    def render_key(user_hosts, updators):
+        key = hashlib.md5(('v%d\n' %RENDER_VERSION).encode('utf8'))
+        key.update(''.join(user_hosts).encode('utf8'))
+        for u in updators:
+            key.update(('\n%s:%s' %(u.name, u.source_digest())).encode('utf8'))
+            if u.filters['allow'] or u.filters['deny']:
+                key.update(json.dumps(u.filters, sort_keys=True).encode('utf8'))
+        return key.hexdigest()
+
+
+    # 将完整的 hosts 内容渲染到 path，cached 为 [(name, path, filter)]，filter 为 None 表示不过滤
+    # 缓存在拉取时已统一为 utf-8，单个源且不过滤时直接复制字节，无需解码再编码
+    @staticmethod
+    def render(path, user_hosts, cached):
+        with open(path, 'wb') as f:
+            f.write(''.join(user_hosts + [SEPARATOR, '\n']).encode('utf8'))
+            if len(cached) == 1 and cached[0][2] is None:
+                with compression.open_read(cached[0][1]) as d:
+                    shutil.copyfileobj(d, f, CHUNK_SIZE)
+                return
+            sources = []
+            for name, cache, hosts_filter in cached:
+                lines = parser.iter_lines(cache)
+                sources.append((name, hosts_filter.filter_lines(lines) if hosts_filter else lines))
+            out = io.TextIOWrapper(f, encoding='utf8', newline='')
+            if len(sources) == 1:
+                out.writelines(sources[0][1])
+            else:
+                stats = merger.merge(sources, out)
+            out.flush()
+            out.detach()
+        for name, _, hosts_filter in cached:
+            for rule, count in sorted((hosts_filter.dropped if hosts_filter else {}).items()):
+                logger.info('Filter rule %s dropped %d hostname(s) from source [%s]' %(rule, count, name))
+        if len(sources) > 1:
+            for stat in stats:
+                logger.info('Merged source [%s]: %d entries, dropped %d duplicates and %d conflicts'
+                    %(stat['name'], stat['entries'], stat['duplicates'], stat['conflicts']))
+
+
+    # 获取渲染结果，命中缓存时直接复用，否则渲染并放入 data/.rendered/
+    def get_rendered(self, user_hosts, updators):
+        render_dir = os.path.join(self.app_root, 'data', '.rendered')
+        if not os.path.isdir(render_dir):
+            os.makedirs(render_dir)
+        with metrics.timed('render', source=', '.join(u.name for u in updators)) as event:
+            rendered = os.path.join(render_dir, self.render_key(user_hosts, updators) + '.hosts')
+            if os.path.isfile(rendered):
+                os.utime(rendered, None)
+                event.update({'status': 'cached', 'bytes': os.path.getsize(rendered)})
+                return rendered
+            cached = [(u.name, u.cached_hosts(), u.make_filter()) for u in updators]
+            fd, tmp_file = tempfile.mkstemp(prefix='.hosts.', suffix='.tmp', dir=render_dir)
+            os.close(fd)
+            try:
+                self.render(tmp_file, user_hosts, cached)
+                replace_file(tmp_file, rendered)
+            except BaseException:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            event.update({'status': 'rendered', 'bytes': os.path.getsize(rendered)})
+        self.prune_rendered(render_dir)
+        return rendered
+
+
+    # 只保留最近使用的 render_cache_size 个渲染结果
+    def prune_rendered(self, render_dir):
+        files = [os.path.join(render_dir, n) for n in os.listdir(render_dir) if n.endswith('.hosts')]
+        files.sort(key=os.path.getmtime, reverse=True)
+        for path in files[self.render_cache_size:]:
+            os.remove(path)
+
+
+    # 以原子方式安装 hosts：先写入同目录下的临时文件并 fsync，再替换原文件
+    # 替换前保留原文件的权限和属主，其他进程任何时候都不会读到写了一半的文件
+    # hosts 是挂载点而无法被替换时（如容器中 bind mount 的 /etc/hosts），改为原地写入并校验
+    def install(self, rendered, hosts_file, require_separator=True):
+        hosts_dir = os.path.dirname(hosts_file)
+        fd, tmp_file = tempfile.mkstemp(prefix='.hosts.', suffix='.tmp', dir=hosts_dir)
+        try:
+            with os.fdopen(fd, 'wb') as dst, open(rendered, 'rb') as src:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            self.copy_owner_and_mode(hosts_file, tmp_file)
+            if self.verify_install:
+                self.verify_hosts(tmp_file, rendered, require_separator)
+            try:
+                replace_file(tmp_file, hosts_file)
+            except OSError as e:
+                if e.errno not in (errno.EBUSY, errno.EXDEV):
+                    raise
+                logger.warning('Cannot replace %s (%s), writing it in place instead' %(hosts_file, e))
+                self.write_in_place(tmp_file, hosts_file)
+                os.remove(tmp_file)
+                return
+        except BaseException:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            raise
+        # 确保目录项的变更也落盘
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(hosts_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+
+    # 比较当前源上一次与本次拉取的内容，返回 (added, removed, changed)，见 parser.diff_entries
+    # 上一次的内容取自历史版本中最近的一个与当前内容不同的版本
+    def diff(self):
+        current = self.cached_hosts()
+        digest = self.source_digest()
+        history = self.history()
+        previous = [v for v in history.versions() if v['digest'] != digest]
+        if not previous:
+            raise Exception('No previous version of source [%s] in history, pull it again after it changes' %self.name)
+        return parser.diff_entries(parser.iter_entries(history.iter_lines(previous[-1]['version'])),
+            parser.iter_file(current))
+
+
+    # 将 src 的内容原地写入 dst 并 fsync，写入后逐字节比较；先覆盖再截断，写入期间文件不会为空
+    # 不是原子的，写入期间其他进程可能读到新旧混合的内容
+    @staticmethod
+    def write_in_place(src, dst):
+        with open(src, 'rb') as fsrc, open(dst, 'r+b') as fdst:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+            fdst.truncate()
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        if not filecmp.cmp(src, dst, shallow=False):
+            raise Exception('Verification failed: hosts written in place differs from rendered result')
+
+
+    @staticmethod
+    def copy_owner_and_mode(src, dst):
+        if not os.path.exists(src):
+            # mkstemp 创建的文件只有属主可读，hosts 需要所有用户可读
+            os.chmod(dst, 0o644)
+            return
+        st = os.stat(src)
+        shutil.copymode(src, dst)
+        if hasattr(os, 'chown'):
+            try:
+                os.chown(dst, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+
+
+    # 校验待安装的 hosts：内容与渲染结果逐字节一致，并且包含分隔行（可以被下次切换识别出用户部分）
+    # 各行的合法性在拉取时已经校验过（见 util/validator.py），这里不再逐行检查
+    @staticmethod
+    def verify_hosts(path, rendered, require_separator=True):
+        if not filecmp.cmp(path, rendered, shallow=False):
+            raise Exception('Verification failed: written hosts differs from rendered result')
+        has_separator = any(line.startswith(SEPARATOR) for line in parser.iter_lines(path))
+        if require_separator and not has_separator:
+            raise Exception('Verification failed: separator line not found in written hosts')
+
+
     # 使用当前源更新系统 hosts
-    def use(self):
-        self.before_use()
+    # merge_with 为其他源的 updator 列表，按顺序合并在当前源之后，主机名冲突时靠前的源优先
+    # 渲染结果与系统 hosts 完全相同时不做任何改动，也不执行 after_use
+    # 持有全局的安装锁，多个进程的切换依次进行，不会同时备份和写入系统 hosts
+    @locked(install_lock_path)
+    def use(self, merge_with=()):
+        updators = [self] + list(merge_with)
+        names = ', '.join(u.name if u.version is None else '%s@%s' %(u.name, u.version) for u in updators)
+        if not self.hosts_exists():
+            self.init_hosts()
         hosts_file = os.path.join(self.hosts_dir, 'hosts')
-        hosts_download = os.path.join(self.working_dir, 'hosts.txt')
         user_hosts = self.get_user_hosts()
-        with codecs.open(hosts_file, 'w', encoding='utf8') as f:
-            f.writelines(user_hosts + [SEPARATOR, '\n'])
-            with codecs.open(hosts_download, 'r', encoding='utf8') as d:
-                self.safe_write(f, d.read())
+        rendered = self.get_rendered(user_hosts, updators)
+        with metrics.timed('install', source=names, bytes=os.path.getsize(rendered)) as event:
+            if filecmp.cmp(rendered, hosts_file, shallow=False):
+                event['status'] = 'up-to-date'
+                logger.info('Hosts is already up-to-date with source [%s]. Quit switching!' %names)
+                return False
+            self.before_use()
+            self.install(rendered, hosts_file)
+            self.write_separator_offset(hosts_file, user_hosts)
+            event['status'] = 'installed'
         self.after_use()
-        logger.info('Success switching hosts to source [%s]' %self.name)
+        logger.info('Success switching hosts to source [%s]' %names)
+        return True
 
 
-    # hosts 更新之后，还需要刷新 DNS 或重启网络适配器等后续工作
+    # hosts 更新之后刷新 DNS 缓存等后续工作，见 util/hooks.py
+    # 默认只刷新当前系统上实际存在的缓存，不再重启网络，不会中断现有连接
     def after_use(self):
-        if self.system == 'Windows':
-            os.system('ipconfig /flushdns')
-            return
-        if self.system == 'Linux':
-            os.system('sudo /etc/init.d/networking restart')
-            return
-        if self.system == 'Darwin':
-            os.system('sudo ifconfig en0 down && sudo ifconfig en0 up')
-            return
-        raise Exception('System type error: unknown system "%s"' %self.system)
+        if self.system not in ('Windows', 'Linux', 'Darwin'):
+            raise Exception('System type error: unknown system "%s"' %self.system)
+        with metrics.timed('after-use', source=self.name) as event:
+            results = hooks.run_hooks(self.after_use_hooks, self.system)
+            event.update({'hooks': len(results), 'status': 'ok' if all(r['ok'] for r in results) else 'failed'})
+        return results
+
+
+# 使用有界的线程池并发拉取多个源，单个源失败不影响其他源
+# 返回结果与 updators 顺序一致，每项包含 name、status、bytes、elapsed、error、timing，成功时还有 code、url、attempts
+# 每个源的结果同时记录为 pull 事件，见 util/metrics.py
+def pull_many(updators, workers=PULL_WORKERS):
+    results = [None] * len(updators)
+    tasks = queue.Queue()
+    for i, updator in enumerate(updators):
+        tasks.put((i, updator))
+
+    def worker():
+        while True:
+            try:
+                i, updator = tasks.get_nowait()
+            except queue.Empty:
+                return
+            start = time.time()
+            result = {'name': updator.name, 'status': 'failed', 'bytes': 0, 'error': '', 'timing': {},
+                'mirrors': len(updator.urls)}
+            try:
+                result.update(updator.pull())
+            except Exception as e:
+                result['error'] = str(e) or e.__class__.__name__
+                result['code'] = getattr(e, 'code', None)
+                result['url'] = getattr(e, 'mirror_url', None)
+                logger.error('Failed pulling hosts from source [%s]%s: %s' %(updator.name,
+                    ' from %s' %result['url'] if result['url'] else '', result['error']))
+            result['elapsed'] = time.time() - start
+            results[i] = result
+            metrics.record('pull', result['elapsed'], source=result['name'], status=result['status'],
+                code=result.get('code'), bytes=result['bytes'], attempts=result.get('attempts'), url=result.get('url'),
+                cache_hit=result['status'] in ('not-modified', 'unchanged'), error=result['error'] or None,
+                **result['timing'])
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(updators))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+# 为拉取到新内容的源重建主机名索引（见 util/lookup.py），在拉取和安装都完成之后调用，
+# 不占用拉取锁；所有源由同一个连接依次写入，索引失败只输出警告，下次 which/grep 时会补建
+def index_sources(app_root, updators):
+    if not updators:
+        return
+    names = ', '.join(u.name for u in updators)
+    try:
+        with metrics.timed('index', source=names):
+            index = LookupIndex(app_root, updators[0].lock_timeout)
+            try:
+                index.refresh(updators)
+            finally:
+                index.close()
+    except Exception as e:
+        logger.warning('Failed indexing hostnames of source [%s]: %s' %(names, e))
+
+
+# 格式化拉取结果汇总表，各阶段耗时以毫秒为单位，复用连接时 dns/connect/tls 为 0
+TIMING_COLUMNS = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+
+
+def format_pull_summary(results, elapsed=None):
+    header = '{:<16}{:<14}{:>12}{:>10}'.format('name', 'status', 'bytes', 'elapsed')
+    lines = [header + ''.join('{:>10}'.format(c) for c in TIMING_COLUMNS) + '  reused']
+    for r in results:
+        line = '{:<16}{:<14}{:>12}{:>9.2f}s'.format(r['name'], r['status'], r['bytes'], r['elapsed'])
+        timing = r.get('timing') or {}
+        if timing:
+            line += ''.join('{:>8.0f}ms'.format(timing.get(c, 0) * 1000) for c in TIMING_COLUMNS)
+            line += '  ' + ('yes' if timing.get('reused') else 'no')
+        lines.append(line)
+        # 多镜像或经过重试的源显示实际使用的地址
+        if r.get('url') and (r['attempts'] > 1 or r['mirrors'] > 1):
+            lines.append('    mirror: %s (attempt %d)' %(r['url'], r['attempts']))
+        if r['error']:
+            lines.append('    error: %s' %r['error'])
+    if elapsed is not None:
+        failed = len([r for r in results if r['status'] == 'failed'])
+        lines.append('Pulled %d source(s) in %.2fs, %d failed.' %(len(results), elapsed, failed))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import re
+import socket
+import string
+
+from util import compression
+from util import parser
+
+try:
+    import ipaddress
+except ImportError:
+    # Python 2 没有 ipaddress 时退回到 socket.inet_pton
+    ipaddress = None
+
+# 拉取的内容开头出现这些标签时认为是 HTML 页面（如错误页、登录页）而不是 hosts
+HTML_PATTERN = re.compile(br'<\s*(!doctype\s+html|html|head|body|title)\b', re.I)
+HTML_SNIFF_SIZE = 4096
+# 主机名：以 . 分隔的 label，每个 1~63 个字符，总长不超过 253；允许下划线，常见于广告列表
+HOSTNAME_PATTERN = re.compile(
+    r'^(?=.{1,253}\.?$)[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?(?:\.[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?)*\.?$')
+# 拉取时整块校验用的模式，见 ContentChecker：以 IP 形式的字段开头、只含主机名字符的映射行
+GOOD_LINE_PATTERN = re.compile(br'\n[ \t]*([0-9a-fA-F.:]+)[ \t]+[a-zA-Z0-9_.-][a-zA-Z0-9_. \t-]*(?:#[^\n]*)?(?=\n)')
+# 这些字符组合说明块中可能有空的 label、以 . 开头的主机名或以 - 开头或结尾的 label
+BAD_DOTS = (b'..', b' .', b'\t.')
+BAD_DASH_PATTERN = re.compile(br'-(?:(?=[\s.#])|(?<=[\s.]-))')
+# 将 label 字符映射为 a、主机名字符映射为 a，用于查找过长的 label 和主机名
+LABEL_TABLE = bytes(bytearray(97 if chr(c) in string.ascii_letters + string.digits + '_-' else 32 for c in range(256)))
+HOSTNAME_TABLE = bytes(bytearray(32 if chr(c) in ' \t\n#' else 97 for c in range(256)))
+# 每类问题最多记录的示例行数
+MAX_SAMPLES = 5
+
+# 默认的拒绝条件：条目数比上一版本减少超过 MAX_SHRINK，或无效行的比例超过 MAX_INVALID_RATIO
+MAX_SHRINK = 0.5
+MAX_INVALID_RATIO = 0.05
+
+
+class ValidationError(Exception):
+    """Pulled content rejected by validation; `report` holds the details.\n"""
+    def __init__(self, message, report):
+        Exception.__init__(self, message)
+        self.report = report
+
+
+def _valid_ip_uncached(ip):
+    # IPv6 可能带有 %eth0 形式的区域标识
+    ip = ip.split('%', 1)[0]
+    if ipaddress is not None:
+        try:
+            ipaddress.ip_address(u'%s' %ip)
+            return True
+        except ValueError:
+            return False
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    try:
+        socket.inet_pton(family, ip)
+        return True
+    except (socket.error, ValueError):
+        return False
+
+
+def new_report():
+    return {'lines': 0, 'entries': 0, 'malformed': 0, 'invalid_ip': 0, 'invalid_hostname': 0,
+        'duplicates': 0, 'conflicts': 0, 'html': False, 'samples': [], 'errors': []}
+
+
+def add_sample(report, lineno, reason, line):
+    if len(report['samples']) < MAX_SAMPLES:
+        report['samples'].append((lineno, reason, line.rstrip('\r\n')))
+
+
+class Validator(object):
+    """Bulk lint of a hosts file in a single pass.
+
+    IPs are checked with `ipaddress` and cached, since lists use few distinct IPs;
+    hostnames are checked with one precompiled regex. Duplicate and conflicting
+    mappings are counted separately for IPv4 and IPv6.\n"""
+    def __init__(self, max_shrink=MAX_SHRINK, max_invalid_ratio=MAX_INVALID_RATIO):
+        self.max_shrink = max_shrink
+        self.max_invalid_ratio = max_invalid_ratio
+        self._ip_cache = {}
+
+    def valid_ip(self, ip):
+        valid = self._ip_cache.get(ip)
+        if valid is None:
+            valid = self._ip_cache[ip] = _valid_ip_uncached(ip)
+        return valid
+
+    @staticmethod
+    def is_html(path):
+        with compression.open_read(path) as f:
+            head = f.read(HTML_SNIFF_SIZE)
+        return HTML_PATTERN.search(head) is not None
+
+    # 检查一行并累加到 report，返回 (ip, 合法的主机名列表)；不是有效的映射行时返回 None
+    def check_line(self, report, lineno, line):
+        parsed = parser.parse_line(line)
+        if parsed is None:
+            # 只有一个字段的非注释行
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#'):
+                report['malformed'] += 1
+                add_sample(report, lineno, 'malformed line', line)
+            return None
+        ip, hostnames, _ = parsed
+        report['entries'] += 1
+        if not self.valid_ip(ip):
+            report['invalid_ip'] += 1
+            add_sample(report, lineno, 'invalid ip', line)
+            return None
+        valid = []
+        for hostname in hostnames:
+            if HOSTNAME_PATTERN.match(hostname) is None:
+                report['invalid_hostname'] += 1
+                add_sample(report, lineno, 'invalid hostname', line)
+            else:
+                valid.append(hostname)
+        return ip, valid
+
+    # 检查 path，返回报告：lines、entries、malformed、invalid_ip、invalid_hostname、duplicates、conflicts、html、
+    # samples（[(lineno, reason, line)]）以及 errors；errors 非空表示应当拒绝
+    # previous_entries 为上一版本的条目数，用于检查是否突然大幅减少
+    def validate(self, path, previous_entries=None):
+        report = new_report()
+        report['html'] = self.is_html(path)
+        seen4 = {}
+        seen6 = {}
+        lineno = 0
+        for lineno, line in enumerate(parser.iter_lines(path), 1):
+            checked = self.check_line(report, lineno, line)
+            if checked is None:
+                continue
+            ip, hostnames = checked
+            seen = seen6 if ':' in ip else seen4
+            for hostname in hostnames:
+                mapped = seen.get(hostname)
+                if mapped is None:
+                    seen[hostname] = ip
+                elif mapped == ip:
+                    report['duplicates'] += 1
+                else:
+                    report['conflicts'] += 1
+                    add_sample(report, lineno, 'conflicts with %s' %mapped, line)
+        report['lines'] = lineno
+        self.check(report, previous_entries)
+        return report
+
+    # 拉取时使用的流式校验，见 ContentChecker
+    def stream(self, previous_entries=None):
+        return ContentChecker(self, previous_entries)
+
+    # 根据统计结果判断是否拒绝，原因追加到 report['errors']
+    def check(self, report, previous_entries=None):
+        errors = report['errors']
+        if report['html']:
+            errors.append('content looks like an HTML page')
+        if report['entries'] == 0:
+            errors.append('no hosts entry found')
+        invalid = report['malformed'] + report['invalid_ip'] + report['invalid_hostname']
+        total = report['entries'] + report['malformed']
+        if total and float(invalid) / total > self.max_invalid_ratio:
+            errors.append('%d of %d entries are malformed' %(invalid, total))
+        if previous_entries and report['entries'] < previous_entries * (1 - self.max_shrink):
+            errors.append('entries shrank from %d to %d' %(previous_entries, report['entries']))
+        return errors
+
+
+class ContentChecker(object):
+    """Validation of a UTF-8 stream fed in chunks while it is downloaded, like `parser.EntryCounter`.
+
+    A block of whole lines is accepted without parsing its lines when every mapping line in it
+    matches `GOOD_LINE_PATTERN`, its IPs are valid and a few substring searches find no label
+    that breaks `HOSTNAME_PATTERN`, which is the common case; other blocks are checked line by
+    line. Duplicates and conflicts are not counted (None), `lint` counts them.\n"""
+    def __init__(self, validator, previous_entries=None):
+        self.validator = validator
+        self.previous_entries = previous_entries
+        self.report = new_report()
+        self.report['duplicates'] = self.report['conflicts'] = None
+        self._head = b''
+        self._tail = b''
+
+    def feed(self, data):
+        if len(self._head) < HTML_SNIFF_SIZE:
+            self._head += data[:HTML_SNIFF_SIZE - len(self._head)]
+        data = self._tail + data
+        cut = data.rfind(b'\n') + 1
+        self._tail = data[cut:]
+        if cut:
+            self._check_block(data[:cut])
+
+    # 检查剩余的内容，返回与 Validator.validate 格式相同的报告
+    def finish(self):
+        if self._tail:
+            self._check_block(self._tail)
+            self._tail = b''
+        self.report['html'] = HTML_PATTERN.search(self._head) is not None
+        self.validator.check(self.report, self.previous_entries)
+        return self.report
+
+    def _check_block(self, block):
+        report = self.report
+        first = report['lines'] + 1
+        report['lines'] += block.count(b'\n') + (not block.endswith(b'\n'))
+        entries = parser.count_mapping_lines(block)
+        if self._is_good(block, entries):
+            report['entries'] += entries
+            return
+        lines = block.split(b'\n')
+        if not lines[-1]:
+            lines.pop()
+        check_line = self.validator.check_line
+        for lineno, line in enumerate(lines, first):
+            check_line(report, lineno, line.decode('utf8', 'replace'))
+
+    # 块中的映射行是否都合法，entries 为块中映射行的个数
+    def _is_good(self, block, entries):
+        padded = b'\n' + block + (b'' if block.endswith(b'\n') else b'\n')
+        ips = GOOD_LINE_PATTERN.findall(padded)
+        if len(ips) != entries:
+            return False
+        if any(s in block for s in BAD_DOTS) or BAD_DASH_PATTERN.search(block) is not None:
+            return False
+        if b'a' * 64 in block.translate(LABEL_TABLE) or b'a' * 254 in block.translate(HOSTNAME_TABLE):
+            return False
+        valid_ip = self.validator.valid_ip
+        return all(valid_ip(ip.decode('ascii').lower()) for ip in set(ips))
+
+
+# 单行的报告摘要，拉取时的报告不含重复和冲突的统计
+def format_report(report):
+    text = ('%(lines)d lines, %(entries)d entries, %(malformed)d malformed lines, %(invalid_ip)d invalid IPs, '
+        '%(invalid_hostname)d invalid hostnames' %report)
+    if report['duplicates'] is not None:
+        text += ', %(duplicates)d duplicates, %(conflicts)d conflicts' %report
+    return text